@@ -1,12 +1,27 @@
-from Xlib import X, display, Xutil, error, XK, Xcursorfont
+from Xlib import X, display, Xutil, error, XK, Xcursorfont, Xatom
+from Xlib.ext import composite, damage
+from Xlib.protocol import request, event as xevent
+from collections import OrderedDict
+from array import array
 import subprocess
+import shlex
 import sys
 import logging
 import os
 import json
+import re
 import traceback
+import threading
+import queue
+import select
+import time
+import base64
+import bisect
+import math
 
 app_name = "simplepywm"
+# Workspaces 1..workspace_count, one Super+number binding each
+workspace_count = 9
 
 user = os.getenv("USER")
 path = f"/home/{user}/.config/{app_name}"
@@ -41,7 +56,8 @@ default_config = {
                 "button_active_background_color": "white",
                 "button_active_font_color": "black",
                 "button_passive_background_color": "black",
-                "button_passive_font_color": "green"
+                "button_passive_font_color": "green",
+                "font": "fixed"
             },
             "minimize": {
                 "color": "#FFBD44"
@@ -51,6 +67,12 @@ default_config = {
             },
             "close": {
                 "color": "#FF605C"
+            },
+            "switcher": {
+                "thumbnail_width": 240,
+                "thumbnail_height": 180,
+                "thumbnail_cache_size": 16777216,
+                "background_color": "black"
             }
         }
     },
@@ -58,6 +80,32 @@ default_config = {
         "terminal": ["kitty"],
         "filemanager": ["kitty", "lf"],
         "launcher": ["dmenu_run"]
+    },
+    "keybindings": [
+        {"key": "T", "modifiers": ["Control", "Shift"], "action": "spawn", "args": ["terminal"]},
+        {"key": "E", "modifiers": ["Control"], "action": "spawn", "args": ["filemanager"]},
+        {"key": "space", "modifiers": ["Control"], "action": "spawn", "args": ["launcher"]},
+        {"key": "Left", "modifiers": ["Control"], "action": "snap", "args": ["left"]},
+        {"key": "Right", "modifiers": ["Control"], "action": "snap", "args": ["right"]},
+        {"key": "Up", "modifiers": ["Control"], "action": "snap", "args": ["up"]},
+        {"key": "Down", "modifiers": ["Control"], "action": "snap", "args": ["down"]},
+        {"key": "Q", "modifiers": ["Mod4"], "action": "quit"},
+        {"key": "Tab", "modifiers": ["Mod1"], "action": "cycle_windows"},
+        {"key": "Tab", "modifiers": ["Mod1", "Shift"], "action": "cycle_windows", "args": [True]}
+    ] + [
+        {"key": str(workspace), "modifiers": ["Mod4"], "action": "switch_workspace", "args": [workspace]}
+        for workspace in range(1, workspace_count + 1)
+    ],
+    "rules": [
+        {
+            "match": {"class": "Polybar"},
+            "manage": False
+        }
+    ],
+    "debug": {
+        "trace_file": "",
+        # Log the event loop's stack when one event takes longer than this, 0 turns it off
+        "stall_threshold_ms": 250
     }
 }
 
@@ -65,18 +113,835 @@ if("config.json" not in os.listdir(path)):
     with open(f"{path}/config.json", "w") as file:
         file.write(json.dumps(default_config, indent=4))
 
-config = json.load(open(os.path.expanduser(f"{path}/config.json"), "r"))
+MODIFIER_MASKS = {
+    "Shift": X.ShiftMask,
+    "Control": X.ControlMask,
+    "Mod1": X.Mod1Mask,
+    "Alt": X.Mod1Mask,
+    "Mod2": X.Mod2Mask,
+    "Mod3": X.Mod3Mask,
+    "Mod4": X.Mod4Mask,
+    "Super": X.Mod4Mask,
+    "Mod5": X.Mod5Mask
+}
 
-class SimplePyWM:
+def merge_defaults(defaults, loaded):
+    for key, value in defaults.items():
+        if(key not in loaded):
+            loaded[key] = value
+        elif(isinstance(value, dict) and isinstance(loaded[key], dict)):
+            merge_defaults(value, loaded[key])
+    return loaded
+
+config = merge_defaults(default_config, json.load(open(os.path.expanduser(f"{path}/config.json"), "r")))
+
+class EventRecorder:
+    # Writes one JSON line per event: seconds since start and the raw 32 byte event.
+    # The header carries what a replay needs to rebuild the session without a server.
+    def __init__(self, file_name, d):
+        self.file = open(os.path.expanduser(file_name), "w", buffering=1)
+        self.start = time.monotonic()
+        self.d = d
+        self.atom_names = {}
+        screen = d.screen()
+        info = d.display.info
+        min_keycode = info.min_keycode
+        # Composite and Damage change which resource ids the window manager allocates
+        extensions = [name for name in (composite.extname, damage.extname) if d.has_extension(name)]
+        header = {
+            "resource_id_base": info.resource_id_base,
+            "resource_id_mask": info.resource_id_mask,
+            "root": screen.root.id,
+            "width": screen.width_in_pixels,
+            "height": screen.height_in_pixels,
+            "depth": screen.root_depth,
+            "min_keycode": min_keycode,
+            "keyboard_mapping": [list(syms) for syms in d.get_keyboard_mapping(min_keycode, info.max_keycode - min_keycode + 1)],
+            "modifier_mapping": [list(codes) for codes in d.get_modifier_mapping()],
+            "extensions": extensions,
+            "damage_notify": d.extension_event.DamageNotify if damage.extname in extensions else None,
+            # Windows open before the window manager started, adopt_existing_windows picks them up
+            "windows": self.existing_windows(screen.root)
+        }
+        self.write({"header": header})
+        logger.info(f"Recording X events to {file_name}")
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def atom_name(self, atom):
+        # Atoms differ between servers, traces carry their names
+        if(atom not in self.atom_names):
+            self.atom_names[atom] = self.d.get_atom_name(atom)
+        return self.atom_names[atom]
+
+    def text_property(self, win, name):
+        prop = win.get_full_property(self.d.intern_atom(name), X.AnyPropertyType)
+        return prop.value.decode(errors="replace") if prop else None
+
+    def property_values(self, win, name):
+        prop = win.get_full_property(self.d.intern_atom(name), X.AnyPropertyType)
+        if(not prop):
+            return None
+        if(prop.property_type == Xatom.ATOM):
+            return [self.atom_name(atom) for atom in prop.value]
+        return list(prop.value)
+
+    def record(self, event):
+        entry = {
+            "t": round(time.monotonic() - self.start, 6),
+            "event": base64.b64encode(event._binary).decode()
+        }
+        if(event.type == X.MapRequest):
+            # Replays have no server to ask, so keep what handle_map_request will query
+            try:
+                entry["window"] = self.snapshot(event.window)
+            except Exception as e:
+                logger.debug(f"Could not snapshot window {event.window.id} for trace: {e}")
+        self.write(entry)
+
+    def snapshot(self, win):
+        geom = win.get_geometry()
+        normal_hints = win.get_wm_normal_hints()
+        return {
+            "geometry": [geom.x, geom.y, geom.width, geom.height],
+            "border_width": geom.border_width,
+            "wm_class": win.get_wm_class(),
+            "window_types": self.property_values(win, "_NET_WM_WINDOW_TYPE"),
+            "motif_hints": self.property_values(win, "_MOTIF_WM_HINTS"),
+            "wm_state": self.property_values(win, "_NET_WM_STATE"),
+            "net_wm_name": self.text_property(win, "_NET_WM_NAME"),
+            "wm_name": win.get_wm_name(),
+            "normal_hints_flags": normal_hints.flags if normal_hints else 0
+        }
+
+    def existing_windows(self, root):
+        windows = []
+        for child in root.query_tree().children:
+            try:
+                attributes = child.get_attributes()
+                window = self.snapshot(child)
+            except Exception as e:
+                logger.debug(f"Could not snapshot window {child.id} for trace: {e}")
+                continue
+            window["id"] = child.id
+            window["mapped"] = attributes.map_state == X.IsViewable
+            window["override_redirect"] = bool(attributes.override_redirect)
+            window["input_only"] = attributes.win_class == X.InputOnly
+            windows.append(window)
+        return windows
+
+    def close(self):
+        self.file.close()
+
+BUTTON_ACTIONS = ("close", "maximize", "minimize")
+
+FRAME_EVENT_MASK = X.ButtonPressMask | X.ButtonReleaseMask | X.PointerMotionMask | X.SubstructureRedirectMask | X.SubstructureNotifyMask
+
+class ManagedWindow:
+    __slots__ = ("client", "frame", "buttons", "workspace", "state", "layer", "active", "damage", "saved_geometry", "geometry", "ignore_unmaps", "fullscreen", "properties")
+
+    def __init__(self, client, frame=None, buttons=(), workspace=1, layer="normal"):
+        self.client = client
+        self.frame = frame
+        self.buttons = buttons
+        self.workspace = workspace
+        self.state = "max"
+        # "above" windows (dialogs, splashes, docks) stay over "normal" ones
+        self.layer = layer
+        # Whether the frame currently has the active background
+        self.active = False
+        # Damage object watching the top level window for the switcher thumbnails
+        self.damage = None
+        # (frame geometry, client geometry) from before maximizing
+        self.saved_geometry = None
+        # Last known (x, y, width, height) of the top level window
+        self.geometry = None
+        # UnmapNotify events caused by the window manager itself, like reparenting a mapped window
+        self.ignore_unmaps = 0
+        # (frame geometry, client geometry with border width) from before going fullscreen, None when not fullscreen
+        self.fullscreen = None
+        self.properties = {}
+
+    @property
+    def borderless(self):
+        return self.frame is None
+
+    def toplevel(self):
+        if(self.frame is None):
+            return self.client
+        return self.frame
+
+    def ids(self):
+        ids = [self.client.id]
+        if(self.frame is not None):
+            ids.append(self.frame.id)
+        ids.extend(button.id for button in self.buttons)
+        return ids
+
+    def button_action(self, win_id):
+        for index, button in enumerate(self.buttons):
+            if(button.id == win_id):
+                return BUTTON_ACTIONS[index]
+        return None
+
+class WindowRegistry:
     def __init__(self):
+        # Every X id belonging to a managed window (client, frame, buttons) -> ManagedWindow
+        self.windows = {}
+        # Workspace -> client ids in taskbar / Alt-Tab order
+        self.stacks = {}
+        self.added = 0
+        self.removed = 0
+
+    def add(self, record):
+        for win_id in record.ids():
+            self.windows[win_id] = record
+        self.stack(record.workspace).append(record.client.id)
+        self.added += 1
+
+    def remove(self, record):
+        for win_id in record.ids():
+            if(self.windows.get(win_id) is record):
+                del self.windows[win_id]
+        stack = self.stacks.get(record.workspace)
+        if(stack and record.client.id in stack):
+            stack.remove(record.client.id)
+        self.removed += 1
+
+    def get(self, win_id):
+        return self.windows.get(win_id)
+
+    def stack(self, workspace):
+        if(workspace not in self.stacks):
+            self.stacks[workspace] = []
+        return self.stacks[workspace]
+
+    def records(self):
+        return list({id(record): record for record in self.windows.values()}.values())
+
+    def report(self):
+        records = self.records()
+        expected_ids = sum(len(record.ids()) for record in records)
+        stale_ids = [win_id for win_id, record in self.windows.items() if win_id not in record.ids()]
+        stacked = [win_id for stack in self.stacks.values() for win_id in stack]
+        orphaned = [win_id for win_id in stacked if win_id not in self.windows]
+        size = sys.getsizeof(self.windows) + sys.getsizeof(self.stacks)
+        size += sum(sys.getsizeof(stack) for stack in self.stacks.values())
+        size += sum(sys.getsizeof(record) + sys.getsizeof(record.properties) for record in records)
+        return {
+            "windows": len(records),
+            "indexed_ids": len(self.windows),
+            "expected_ids": expected_ids,
+            "stale_ids": len(stale_ids),
+            "orphaned_stack_entries": len(orphaned),
+            "leaked_records": self.added - self.removed - len(records),
+            "bytes": size
+        }
+
+def overlaps(a, b):
+    return a[0] < b[2] and a[2] > b[0] and a[1] < b[3] and a[3] > b[1]
+
+def contains(a, b):
+    return a[0] <= b[0] and a[1] <= b[1] and a[2] >= b[2] and a[3] >= b[3]
+
+def cut_rectangle(free, rect, within=None):
+    # Cuts rect out of a list of maximal free rectangles. With within set,
+    # only the pieces overlapping it are produced
+    x1, y1, x2, y2 = rect
+    kept = []
+    touching = []
+    pieces = []
+    for area in free:
+        fx1, fy1, fx2, fy2 = area
+        if(x1 >= fx2 or x2 <= fx1 or y1 >= fy2 or y2 <= fy1):
+            kept.append(area)
+            if(x1 <= fx2 and x2 >= fx1 and y1 <= fy2 and y2 >= fy1):
+                touching.append(area)
+            continue
+        if(x1 > fx1):
+            pieces.append((fx1, fy1, x1, fy2))
+        if(x2 < fx2):
+            pieces.append((x2, fy1, fx2, fy2))
+        if(y1 > fy1):
+            pieces.append((fx1, fy1, fx2, y1))
+        if(y2 < fy2):
+            pieces.append((fx1, y2, fx2, fy2))
+    if(within is not None):
+        pieces = [piece for piece in pieces if overlaps(piece, within)]
+
+    # Untouched rectangles are still maximal, only the new pieces can be
+    # contained in another rectangle. A piece borders the cut out rect, so an
+    # old rectangle containing it has to border it as well
+    for index, piece in enumerate(pieces):
+        redundant = False
+        for other_index, other in enumerate(pieces):
+            # Of two equal pieces keep the first one
+            if(other_index != index and contains(other, piece) and (other != piece or other_index < index)):
+                redundant = True
+                break
+        if(not redundant):
+            for other in touching:
+                if(contains(other, piece)):
+                    redundant = True
+                    break
+        if(not redundant):
+            kept.append(piece)
+    return kept
+
+class FreeSpace:
+    # Maximal free rectangles, as (x1, y1, x2, y2), of one workspace's work
+    # area. Window changes are queued and applied to the set incrementally
+    # the next time a window is placed
+    def __init__(self, area):
+        self.area = area
+        self.windows = {}
+        # Rectangles the free set currently accounts for
+        self.applied = {}
+        self.changed = set()
+        self.free = [area]
+
+    def update(self, win_id, rect):
+        if(self.windows.get(win_id) != rect):
+            self.windows[win_id] = rect
+            self.changed.add(win_id)
+
+    def remove(self, win_id):
+        if(self.windows.pop(win_id, None) is not None):
+            self.changed.add(win_id)
+
+    def sync(self):
+        for win_id in self.changed:
+            old = self.applied.pop(win_id, None)
+            new = self.windows.get(win_id)
+            if(old is not None and not (new is not None and contains(new, old))):
+                # Growing only takes space away, anything else frees some
+                self.release(old)
+            if(new is not None):
+                self.free = cut_rectangle(self.free, new)
+                self.applied[win_id] = new
+        self.changed.clear()
+
+    def release(self, rect):
+        # Every new maximal rectangle overlaps the released one. Find them by
+        # cutting the other windows out of the area, following only the pieces
+        # that still overlap it. Old rectangles stay maximal unless one of the
+        # new ones swallows them
+        grown = [self.area] if overlaps(self.area, rect) else []
+        for other in self.applied.values():
+            if(not grown):
+                break
+            grown = cut_rectangle(grown, other, rect)
+        kept = [area for area in self.free if not any(contains(new, area) for new in grown)]
+        self.free = kept + grown
+
+    def place(self, width, height):
+        self.sync()
+        ax1, ay1, ax2, ay2 = self.area
+
+        # Top-most, then left-most free rectangle the window fits in
+        best = None
+        for free in self.free:
+            if(free[2] - free[0] >= width and free[3] - free[1] >= height):
+                if(best is None or (free[1], free[0]) < (best[1], best[0])):
+                    best = free
+        if(best is None and self.free):
+            # Nothing fits, overlap as little as possible by using the largest gap
+            best = max(self.free, key=lambda free: (free[2] - free[0]) * (free[3] - free[1]))
+        if(best is None):
+            best = self.area
+
+        x = max(ax1, min(best[0], ax2 - width))
+        y = max(ay1, min(best[1], ay2 - height))
+        return x, y
+
+class ThumbnailCache:
+    # Least recently used switcher thumbnails (pixmaps on the server), bounded by their size in bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.stale = set()
+        self.bytes = 0
+
+    def get(self, win_id):
+        entry = self.entries.get(win_id)
+        if(entry):
+            self.entries.move_to_end(win_id)
+        return entry
+
+    def needs_refresh(self, win_id):
+        return win_id not in self.entries or win_id in self.stale
+
+    def put(self, win_id, pixmap, width, height):
+        self.remove(win_id)
+        self.entries[win_id] = (pixmap, width, height)
+        self.bytes += width * height * 4
+        while(self.bytes > self.max_bytes and len(self.entries) > 1):
+            old_id = next(iter(self.entries))
+            self.remove(old_id)
+
+    def invalidate(self, win_id):
+        self.stale.add(win_id)
+
+    def remove(self, win_id):
+        self.stale.discard(win_id)
+        entry = self.entries.pop(win_id, None)
+        if(entry):
+            pixmap, width, height = entry
+            pixmap.free()
+            self.bytes -= width * height * 4
+
+class TextMeasurer:
+    # Glyph advances are read once with QueryFont, titles are then measured and cut on the client
+    def __init__(self, font, cache_size=1024):
+        info = font.query()
+        self.first_char = info.min_char_or_byte2
+        # A font whose glyphs all share the same metrics may send no per glyph list
+        self.advances = [char_info.character_width for char_info in info.char_infos]
+        self.default_width = info.max_bounds.character_width
+        default_index = info.default_char - self.first_char
+        if(0 <= default_index < len(self.advances) and self.advances[default_index]):
+            self.default_width = self.advances[default_index]
+        self.ellipsis = "..."
+        self.ellipsis_width = self.text_width(self.ellipsis)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def char_width(self, char):
+        index = ord(char) - self.first_char
+        if(0 <= index < len(self.advances) and self.advances[index]):
+            return self.advances[index]
+        return self.default_width
+
+    def text_width(self, text):
+        return sum(self.char_width(char) for char in text)
+
+    def fit(self, text, width):
+        key = (text, width)
+        if(key in self.cache):
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        fitted = self.ellipsize(text, width)
+        self.cache[key] = fitted
+        if(len(self.cache) > self.cache_size):
+            self.cache.popitem(last=False)
+        return fitted
+
+    def ellipsize(self, text, width):
+        if(self.text_width(text) <= width):
+            return text
+        available = width - self.ellipsis_width
+        if(available <= 0):
+            return ""
+        used = 0
+        for index, char in enumerate(text):
+            used += self.char_width(char)
+            if(used > available):
+                return text[:index] + self.ellipsis
+        return text
+
+def fetch_window_properties(d, win_id, atoms):
+    # atoms: the interned property atoms, see SimplePyWM.setup_ewmh
+    NET_WM_NAME, UTF8_STRING, NET_WM_WINDOW_TYPE, MOTIF_WM_HINTS, NET_WM_STATE = atoms
+    win = d.create_resource_object('window', win_id)
+    try:
+        wm_class = win.get_wm_class()
+        net_wm_name = win.get_full_property(NET_WM_NAME, UTF8_STRING)
+        window_types = win.get_full_property(NET_WM_WINDOW_TYPE, X.AnyPropertyType)
+        motif_hints = win.get_full_property(MOTIF_WM_HINTS, X.AnyPropertyType)
+        normal_hints = win.get_wm_normal_hints()
+        wm_state = win.get_full_property(NET_WM_STATE, Xatom.ATOM)
+        if(net_wm_name):
+            name = net_wm_name.value.decode(errors="replace")
+        else:
+            name = win.get_wm_name()
+    except error.XError as e:
+        logger.debug(f"Could not read properties of {win_id}: {e}")
+        return None
+
+    return window_properties(
+        wm_class,
+        name,
+        list(window_types.value) if window_types else [],
+        list(motif_hints.value) if motif_hints else [],
+        normal_hints.flags if normal_hints else 0,
+        list(wm_state.value) if wm_state else []
+    )
+
+def request_window_properties(d, win_id, atoms):
+    # Sends the requests behind fetch_window_properties without waiting for their replies
+    NET_WM_NAME, UTF8_STRING, NET_WM_WINDOW_TYPE, MOTIF_WM_HINTS, NET_WM_STATE = atoms
+    def get_property(atom, property_type, length=1024):
+        return request.GetProperty(
+            display=d.display,
+            defer=True,
+            delete=False,
+            window=win_id,
+            property=atom,
+            type=property_type,
+            long_offset=0,
+            long_length=length
+        )
+    return (
+        get_property(Xatom.WM_CLASS, Xatom.STRING),
+        get_property(NET_WM_NAME, UTF8_STRING),
+        get_property(Xatom.WM_NAME, Xatom.STRING),
+        get_property(NET_WM_WINDOW_TYPE, X.AnyPropertyType),
+        get_property(MOTIF_WM_HINTS, X.AnyPropertyType),
+        # Only the flags at the start of WM_SIZE_HINTS are needed
+        get_property(Xatom.WM_NORMAL_HINTS, Xatom.WM_SIZE_HINTS, 1),
+        get_property(NET_WM_STATE, Xatom.ATOM)
+    )
+
+def read_window_properties(replies):
+    values = []
+    for reply in replies:
+        reply.reply()
+        values.append(reply.value[1] if reply.property_type else None)
+    wm_class, net_wm_name, wm_name, window_types, motif_hints, normal_hints, wm_state = values
+
+    if(wm_class is not None):
+        parts = wm_class.decode("latin-1").split("\0")
+        wm_class = (parts[0], parts[1]) if len(parts) > 1 else None
+    if(net_wm_name is not None):
+        name = net_wm_name.decode(errors="replace")
+    else:
+        name = wm_name.decode("latin-1") if wm_name is not None else None
+    return window_properties(
+        wm_class,
+        name,
+        list(window_types) if window_types else [],
+        list(motif_hints) if motif_hints else [],
+        normal_hints[0] if normal_hints else 0,
+        list(wm_state) if wm_state else []
+    )
+
+def window_properties(wm_class, name, window_types, motif_hints, normal_hints_flags, wm_state):
+    if wm_class and len(wm_class) > 1:
+        title = wm_class[1]
+    elif wm_class:
+        title = wm_class[0]
+    else:
+        title = "Unknown"
+    return {
+        "wm_class": wm_class,
+        "title": title,
+        "name": name,
+        "window_types": window_types,
+        "motif_hints": motif_hints,
+        "normal_hints_flags": normal_hints_flags,
+        "wm_state": wm_state
+    }
+
+class WindowRule:
+    __slots__ = ("index", "instance", "window_class", "title", "window_type", "actions")
+
+    def __init__(self, index, rule, d):
+        match = rule.get("match", {})
+        self.index = index
+        self.instance = match.get("instance")
+        self.window_class = match.get("class")
+        self.title = re.compile(match["title"]) if "title" in match else None
+        self.window_type = None
+        if("type" in match):
+            self.window_type = d.intern_atom("_NET_WM_WINDOW_TYPE_" + match["type"].upper())
+        self.actions = {key: value for key, value in rule.items() if key != "match"}
+
+    def matches(self, instance, window_class, properties):
+        if(self.instance is not None and self.instance != instance):
+            return False
+        if(self.window_class is not None and self.window_class != window_class):
+            return False
+        if(self.title is not None and not self.title.search(properties["name"] or "")):
+            return False
+        if(self.window_type is not None and self.window_type not in properties["window_types"]):
+            return False
+        return True
+
+class WindowRules:
+    # Rules are indexed by WM_CLASS class, then instance, the rest are tried on every map
+    def __init__(self, rules, d):
+        self.by_class = {}
+        self.by_instance = {}
+        self.fallback = []
+        for index, rule in enumerate(rules):
+            compiled = WindowRule(index, rule, d)
+            if(compiled.window_class is not None):
+                self.by_class.setdefault(compiled.window_class, []).append(compiled)
+            elif(compiled.instance is not None):
+                self.by_instance.setdefault(compiled.instance, []).append(compiled)
+            else:
+                self.fallback.append(compiled)
+
+    def match(self, properties):
+        instance, window_class = None, None
+        if(properties["wm_class"]):
+            instance, window_class = (tuple(properties["wm_class"]) + (None,))[:2]
+        candidates = self.by_class.get(window_class, []) + self.by_instance.get(instance, []) + self.fallback
+        actions = {}
+        # Later rules override earlier ones, as written in config.json
+        for rule in sorted(candidates, key=lambda rule: rule.index):
+            if(rule.matches(instance, window_class, properties)):
+                actions.update(rule.actions)
+        return actions
+
+class PropertyFetcher(threading.Thread):
+    # Reads client properties on a second connection so a slow client never blocks the event loop.
+    # Results go back through a queue and a byte on the wake pipe.
+    def __init__(self, wake_fd, atoms):
+        super().__init__(name="property-fetcher", daemon=True)
         self.d = display.Display()
+        self.wake_fd = wake_fd
+        # Atoms are server wide, the ones interned on the main connection work here too
+        self.atoms = atoms
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+
+    def fetch(self, win_id, reason):
+        self.requests.put((win_id, reason))
+
+    def run(self):
+        while True:
+            win_id, reason = self.requests.get()
+            try:
+                properties = fetch_window_properties(self.d, win_id, self.atoms)
+            except Exception:
+                logger.warning(f"Property fetch for {win_id} failed: {traceback.format_exc()}")
+                properties = None
+            self.results.put((win_id, reason, properties))
+            os.write(self.wake_fd, b"\0")
+
+class RequestBatcher:
+    # Window changes made while handling one event. Every window keeps only the last value of each
+    # field and changes matching what was last sent are dropped. flush() sends the rest once per
+    # iteration: unmaps, geometry, attributes, maps, stacking, then focus.
+    GEOMETRY_FIELDS = ("x", "y", "width", "height", "border_width")
+
+    def __init__(self):
+        self.windows = {}
+        self.configures = {}
+        # Windows whose geometry goes out even when it matches what was sent last
+        self.forced = set()
+        self.attributes = {}
+        self.clears = set()
+        self.maps = {}
+        self.restacks = []
+        self.focus = None
+
+        # Last values sent per window
+        self.sent_geometry = {}
+        self.sent_attributes = {}
+        self.mapped = {}
+
+        self.queued = 0
+        self.sent = 0
+
+    def configure(self, win, force=False, **values):
+        self.queued += 1
+        self.windows[win.id] = win
+        stacking = {name: values.pop(name) for name in ("sibling", "stack_mode") if name in values}
+        if(values):
+            self.configures.setdefault(win.id, {}).update(values)
+            if(force):
+                self.forced.add(win.id)
+        if(stacking):
+            self.restacks.append((win.id, stacking))
+
+    def change_attributes(self, win, **values):
+        self.queued += 1
+        self.windows[win.id] = win
+        self.attributes.setdefault(win.id, {}).update(values)
+
+    def clear_area(self, win):
+        self.queued += 1
+        self.windows[win.id] = win
+        self.clears.add(win.id)
+
+    def map(self, win):
+        self.queued += 1
+        self.windows[win.id] = win
+        self.maps[win.id] = True
+
+    def unmap(self, win):
+        self.queued += 1
+        self.windows[win.id] = win
+        self.maps[win.id] = False
+
+    def unmapped(self, win_id):
+        # The window got unmapped without a request from here, a later map must go out
+        if(win_id in self.mapped):
+            self.mapped[win_id] = False
+
+    def changed(self, win_id, **values):
+        # The server changed the geometry on its own (reparent, ConfigureNotify). Cached fields
+        # that no longer match are dropped so the next configure of them goes out
+        sent = self.sent_geometry.get(win_id)
+        if(sent is None):
+            return
+        for name, value in values.items():
+            if(sent.get(name) != value):
+                sent.pop(name, None)
+
+    def set_input_focus(self, win, revert_to):
+        self.queued += 1
+        self.focus = (win, revert_to)
+
+    def geometry(self, win):
+        # Server geometry with the changes still waiting here applied
+        geom = win.get_geometry()
+        for name, value in self.configures.get(win.id, {}).items():
+            setattr(geom, name, value)
+        return geom
+
+    def forget(self, win_ids):
+        # For destroyed windows: nothing may be sent to them anymore and their ids can be reused
+        for win_id in win_ids:
+            for pending in (self.windows, self.configures, self.attributes, self.maps, self.sent_geometry, self.sent_attributes, self.mapped):
+                pending.pop(win_id, None)
+            self.clears.discard(win_id)
+            self.forced.discard(win_id)
+        self.restacks = [(win_id, stacking) for win_id, stacking in self.restacks if win_id not in win_ids]
+        if(self.focus and self.focus[0].id in win_ids):
+            self.focus = None
+
+    def flush(self):
+        for win_id, mapped in self.maps.items():
+            if(not mapped and self.mapped.get(win_id) is not False):
+                self.windows[win_id].unmap()
+                self.mapped[win_id] = False
+                self.sent += 1
+
+        for win_id, values in self.configures.items():
+            sent = self.sent_geometry.setdefault(win_id, {})
+            if(win_id in self.forced):
+                changed = values
+            else:
+                changed = {name: value for name, value in values.items() if sent.get(name) != value}
+            if(changed):
+                self.windows[win_id].configure(**changed)
+                sent.update(changed)
+                self.sent += 1
+
+        for win_id, values in self.attributes.items():
+            sent = self.sent_attributes.setdefault(win_id, {})
+            changed = {name: value for name, value in values.items() if sent.get(name) != value}
+            if(changed):
+                self.windows[win_id].change_attributes(**changed)
+                sent.update(changed)
+                self.sent += 1
+
+        for win_id in sorted(self.clears):
+            self.windows[win_id].clear_area()
+            self.sent += 1
+
+        for win_id, mapped in self.maps.items():
+            if(mapped and self.mapped.get(win_id) is not True):
+                self.windows[win_id].map()
+                self.mapped[win_id] = True
+                self.sent += 1
+
+        for win_id, stacking in self.restacks:
+            self.windows[win_id].configure(**stacking)
+            self.sent += 1
+
+        if(self.focus):
+            win, revert_to = self.focus
+            win.set_input_focus(revert_to, X.CurrentTime)
+            self.sent += 1
+
+        self.windows = {}
+        self.configures = {}
+        self.forced = set()
+        self.attributes = {}
+        self.clears = set()
+        self.maps = {}
+        self.restacks = []
+        self.focus = None
+
+    @property
+    def saved(self):
+        return self.queued - self.sent
+
+class StallWatchdog(threading.Thread):
+    # Watches the event loop from the side. When one event takes longer than the threshold
+    # the main thread's stack, the event and its window go to the log.
+    def __init__(self, threshold):
+        super().__init__(name="stall-watchdog", daemon=True)
+        self.threshold = threshold
+        self.main_thread_id = threading.get_ident()
+        # (start, event or description) of the work in progress, swapped atomically by the main thread
+        self.work = None
+        self.reported = None
+        self.stalls = {}
+
+    def begin(self, work):
+        self.work = (time.monotonic(), work)
+
+    def end(self):
+        work = self.work
+        self.work = None
+        if(work is not None and work is self.reported):
+            logger.warning(f"Stalled {self.describe(work[1])} finished after {(time.monotonic() - work[0]) * 1000:.0f} ms")
+
+    def describe(self, work):
+        if(isinstance(work, str)):
+            return work
+        window = getattr(work, "window", None)
+        window_id = window if isinstance(window, int) else getattr(window, "id", None)
+        return f"{work.__class__.__name__} for window {window_id}"
+
+    def run(self):
+        while True:
+            work = self.work
+            if(work is None or work is self.reported):
+                time.sleep(self.threshold)
+                continue
+            remaining = work[0] + self.threshold - time.monotonic()
+            if(remaining > 0):
+                time.sleep(remaining)
+                continue
+            self.report(work)
+
+    def report(self, work):
+        frame = sys._current_frames().get(self.main_thread_id)
+        stack = traceback.extract_stack(frame) if frame else []
+        del frame
+        if(self.work is not work):
+            return
+        self.reported = work
+
+        handler = None
+        for entry in reversed(stack):
+            if(entry.name.startswith("handle_")):
+                handler = entry.name
+                break
+        if(handler is None):
+            handler = stack[-1].name if stack else "unknown"
+        self.stalls[handler] = self.stalls.get(handler, 0) + 1
+
+        logger.warning(
+            f"Event loop stalled for {(time.monotonic() - work[0]) * 1000:.0f} ms in {handler} "
+            f"handling {self.describe(work[1])}, stalls by handler: {self.stalls}\n"
+            + "".join(traceback.format_list(stack)).rstrip()
+        )
+
+class SimplePyWM:
+    def __init__(self, d=None, background_fetch=True):
+        if(d is None):
+            d = display.Display()
+        self.d = d
+        self.recorder = None
+        if(config["debug"]["trace_file"]):
+            self.recorder = EventRecorder(config["debug"]["trace_file"], self.d)
+        self.watchdog = None
+        if(config["debug"]["stall_threshold_ms"]):
+            self.watchdog = StallWatchdog(config["debug"]["stall_threshold_ms"] / 1000)
+            self.watchdog.start()
         self.screen = self.d.screen()
         self.root = self.screen.root
-        self.frame_to_client = {}
-        self.client_to_frame = {}
-        self.frame_window_buttons = {}
-        self.frame_to_button_mapping = {}
-        self.old_x_y_width_height = {}
+        self.registry = WindowRegistry()
+        # Window changes made while handling an event, sent at its end
+        self.batch = RequestBatcher()
         self.dragging = False
         self.drag_start_pos = (0, 0)
         self.drag_window = None
@@ -128,7 +993,7 @@ class SimplePyWM:
 
         try:
             self.root.change_attributes(event_mask=X.SubstructureRedirectMask | X.SubstructureNotifyMask)
-            self.grab_shortcut()
+            self.compile_keybindings()
         except error.BadAccess:
             logger.info("Another window manager is already running.")
             sys.exit(1)
@@ -149,39 +1014,405 @@ class SimplePyWM:
             event_mask=X.ExposureMask | X.ButtonPressMask
         )
         self.taskbar.map()
+        # Hidden while a fullscreen window is active
+        self.taskbar_hidden = False
 
         self.active_background_color = self.colormap.alloc_named_color(config["display"]["window"]["frame"]["active_background_color"]).pixel
         self.passive_background_color = self.colormap.alloc_named_color(config["display"]["window"]["frame"]["passive_background_color"]).pixel
+        self.close_color = self.colormap.alloc_named_color(config["display"]["window"]["close"]["color"]).pixel
+        self.maximize_color = self.colormap.alloc_named_color(config["display"]["window"]["maximize"]["color"]).pixel
+        self.minimize_color = self.colormap.alloc_named_color(config["display"]["window"]["minimize"]["color"]).pixel
+
+        self.taskbar_font = self.d.open_font(config["display"]["window"]["taskbar"]["font"])
+        self.text = TextMeasurer(self.taskbar_font)
 
         self.button_active_background_color = self.taskbar.create_gc(foreground=self.colormap.alloc_named_color(config["display"]["window"]["taskbar"]["button_active_background_color"]).pixel)
-        self.button_active_font_color = self.taskbar.create_gc(foreground=self.colormap.alloc_named_color(config["display"]["window"]["taskbar"]["button_active_font_color"]).pixel)
+        self.button_active_font_color = self.taskbar.create_gc(font=self.taskbar_font, foreground=self.colormap.alloc_named_color(config["display"]["window"]["taskbar"]["button_active_font_color"]).pixel)
         self.button_passive_background_color = self.taskbar.create_gc(foreground=self.colormap.alloc_named_color(config["display"]["window"]["taskbar"]["button_passive_background_color"]).pixel)
-        self.button_passive_font_color = self.taskbar.create_gc(foreground=self.colormap.alloc_named_color(config["display"]["window"]["taskbar"]["button_passive_font_color"]).pixel)
+        self.button_passive_font_color = self.taskbar.create_gc(font=self.taskbar_font, foreground=self.colormap.alloc_named_color(config["display"]["window"]["taskbar"]["button_passive_font_color"]).pixel)
 
         self.taskbar_buttons = {}
-        self.borderless_windows = {}
-        self.window_stack = {1:[]}
-        self.workspaces = {1:{}}
         self.current_workspace = 1
-
+        self.registry.stack(self.current_workspace)
+
+        # Managed top level windows bottom to top, as last sent to the server
+        self.stacking = [self.taskbar.id]
+        self.focused_window = None
+
+        self.setup_ewmh()
+        self.setup_switcher()
+        self.rules = WindowRules(config["rules"], self.d)
+        # Workspace -> FreeSpace, used to place new windows where nothing is
+        self.free_spaces = {}
+
+        # Windows waiting for their properties before being framed
+        self.pending_maps = {}
+        self.fetcher = None
+        if(background_fetch):
+            self.wake_read, wake_write = os.pipe()
+            os.set_blocking(self.wake_read, False)
+            self.fetcher = PropertyFetcher(wake_write, self.property_atoms)
+            self.fetcher.start()
+
+        self.adopt_existing_windows()
         self.draw_taskbar()
+        self.batch.flush()
+
+    def adopt_existing_windows(self):
+        start = time.perf_counter()
+        own = {self.taskbar.id, self.switcher.id}
+        children = [child for child in self.root.query_tree().children if child.id not in own]
+
+        # Every request goes out before any reply is read, so the scan takes two
+        # round trips however many windows there are
+        queries = [
+            (
+                child,
+                request.GetWindowAttributes(display=self.d.display, defer=True, window=child.id),
+                request.GetGeometry(display=self.d.display, defer=True, drawable=child.id)
+            )
+            for child in children
+        ]
+        candidates = []
+        for child, attributes, geom in queries:
+            try:
+                attributes.reply()
+                geom.reply()
+            except error.XError:
+                continue
+            if(attributes.override_redirect or attributes.map_state != X.IsViewable or attributes.win_class == X.InputOnly):
+                continue
+            candidates.append((child, geom, request_window_properties(self.d, child.id, self.property_atoms)))
+
+        adopted = []
+        for child, geom, replies in candidates:
+            try:
+                properties = read_window_properties(replies)
+            except error.XError:
+                continue
+            record = self.adopt_window(child, geom, properties)
+            if(record):
+                adopted.append(record)
+
+        visible = [record for record in adopted if record.workspace == self.current_workspace]
+        if(visible):
+            # Keep the order the windows had, under the taskbar
+            order = [record.toplevel().id for record in visible] + self.stacking
+            order.sort(key=self.window_layer)
+            self.restack_windows(order)
+            self.set_active_frame(visible[-1].client)
+        if(adopted):
+            self.set_root_property(self.NET_NUMBER_OF_DESKTOPS, Xatom.CARDINAL, max(self.registry.stacks))
+            self.update_ewmh()
+        logger.info(f"Adopted {len(adopted)} of {len(children)} existing windows ({len(candidates)} viewable) in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def adopt_window(self, win, geom, properties):
+        # A cut down manage_window for windows that are already mapped: no placement, focus or geometry rules
+        actions = self.rules.match(properties)
+        if(not actions.get("manage", True)):
+            return None
+
+        workspace = actions.get("workspace", self.current_workspace)
+        layer = self.window_types_layer(properties["window_types"])
+        if(actions.get("borderless", self.wants_no_border(properties))):
+            win.change_attributes(event_mask=X.ButtonPressMask | X.ButtonReleaseMask | X.SubstructureRedirectMask | X.SubstructureNotifyMask | X.PropertyChangeMask | X.FocusChangeMask)
+            record = ManagedWindow(win, workspace=workspace, layer=layer)
+            record.geometry = (geom.x, geom.y, geom.width + 2 * geom.border_width, geom.height + 2 * geom.border_width)
+        else:
+            frame, buttons = self.create_frame(win, geom.x, geom.y, geom.width, geom.height)
+            record = ManagedWindow(win, frame, buttons, workspace, layer)
+            # The server unmaps the client while reparenting it and maps it again in the frame
+            record.ignore_unmaps = 1
+            record.geometry = (geom.x, geom.y, geom.width + 2, geom.height + self.frame_border_width + 1)
+        record.properties.update(properties)
+        self.registry.add(record)
+        self.track_damage(record)
+        self.ewmh_add_client(win.id)
+        self.occupy(record)
+        if(self.NET_WM_STATE_FULLSCREEN in properties["wm_state"]):
+            self.set_fullscreen(record, True)
+
+        if(workspace != self.current_workspace):
+            self.batch.unmap(win)
+            self.raise_window(record.toplevel().id)
+            if(not self.active_frame.get(workspace)):
+                self.active_frame[workspace] = win
+        elif(not record.borderless):
+            self.batch.map(record.frame)
+        logger.debug(f"Adopted existing window {win.id} on workspace {workspace}")
+        return record
+
+    def setup_ewmh(self):
+        self.NET_SUPPORTED = self.d.intern_atom("_NET_SUPPORTED")
+        self.NET_SUPPORTING_WM_CHECK = self.d.intern_atom("_NET_SUPPORTING_WM_CHECK")
+        self.NET_WM_NAME = self.d.intern_atom("_NET_WM_NAME")
+        self.UTF8_STRING = self.d.intern_atom("UTF8_STRING")
+        self.NET_CLIENT_LIST = self.d.intern_atom("_NET_CLIENT_LIST")
+        self.NET_ACTIVE_WINDOW = self.d.intern_atom("_NET_ACTIVE_WINDOW")
+        self.NET_CURRENT_DESKTOP = self.d.intern_atom("_NET_CURRENT_DESKTOP")
+        self.NET_NUMBER_OF_DESKTOPS = self.d.intern_atom("_NET_NUMBER_OF_DESKTOPS")
+        self.NET_WM_STATE = self.d.intern_atom("_NET_WM_STATE")
+        self.NET_WM_STATE_FULLSCREEN = self.d.intern_atom("_NET_WM_STATE_FULLSCREEN")
+        self.NET_WM_WINDOW_TYPE = self.d.intern_atom("_NET_WM_WINDOW_TYPE")
+        self.MOTIF_WM_HINTS = self.d.intern_atom("_MOTIF_WM_HINTS")
+        # Interned once, every property read of a client needs them
+        self.property_atoms = (self.NET_WM_NAME, self.UTF8_STRING, self.NET_WM_WINDOW_TYPE, self.MOTIF_WM_HINTS, self.NET_WM_STATE)
+        # Window types that open borderless in the "above" layer
+        self.above_window_types = (
+            self.d.intern_atom("_NET_WM_WINDOW_TYPE_DIALOG"),
+            self.d.intern_atom("_NET_WM_WINDOW_TYPE_SPLASH"),
+            self.d.intern_atom("_NET_WM_WINDOW_TYPE_DOCK")
+        )
+
+        # Published _NET_CLIENT_LIST plus the changes not yet written to the root
+        self.net_client_list = []
+        self.net_client_list_appended = []
+        self.net_client_list_rewrite = False
+        # Single valued root properties: atom -> (type, value)
+        self.net_pending = {}
+        self.net_published = {}
+
+        self.taskbar.change_property(self.NET_SUPPORTING_WM_CHECK, Xatom.WINDOW, 32, [self.taskbar.id])
+        self.taskbar.change_property(self.NET_WM_NAME, self.UTF8_STRING, 8, app_name.encode())
+        self.root.change_property(self.NET_SUPPORTING_WM_CHECK, Xatom.WINDOW, 32, [self.taskbar.id])
+        self.root.change_property(self.NET_SUPPORTED, Xatom.ATOM, 32, [
+            self.NET_SUPPORTED,
+            self.NET_SUPPORTING_WM_CHECK,
+            self.NET_CLIENT_LIST,
+            self.NET_ACTIVE_WINDOW,
+            self.NET_CURRENT_DESKTOP,
+            self.NET_NUMBER_OF_DESKTOPS,
+            self.NET_WM_STATE,
+            self.NET_WM_STATE_FULLSCREEN
+        ])
+        self.root.change_property(self.NET_CLIENT_LIST, Xatom.WINDOW, 32, [])
+        self.set_root_property(self.NET_ACTIVE_WINDOW, Xatom.WINDOW, X.NONE)
+        self.set_root_property(self.NET_CURRENT_DESKTOP, Xatom.CARDINAL, self.current_workspace - 1)
+        self.set_root_property(self.NET_NUMBER_OF_DESKTOPS, Xatom.CARDINAL, max(self.registry.stacks))
+        self.update_ewmh()
+
+    def setup_switcher(self):
+        switcher_config = config["display"]["window"]["switcher"]
+        self.thumbnail_width = switcher_config["thumbnail_width"]
+        self.thumbnail_height = switcher_config["thumbnail_height"]
+        self.thumbnails = ThumbnailCache(switcher_config["thumbnail_cache_size"])
+        self.switcher_active = False
+        self.switcher_windows = []
+        self.switcher_selection = 0
+
+        background_pixel = self.colormap.alloc_named_color(switcher_config["background_color"]).pixel
+        self.switcher_background_color = self.taskbar.create_gc(foreground=background_pixel)
+        self.switcher = self.root.create_window(
+            x=0,
+            y=0,
+            width=1,
+            height=1,
+            border_width=0,
+            depth=self.screen.root_depth,
+            class_=X.InputOutput,
+            visual=X.CopyFromParent,
+            background_pixel=background_pixel,
+            override_redirect=True,
+            event_mask=X.ExposureMask
+        )
+
+        self.compositing = self.d.has_extension(composite.extname) and self.d.has_extension(damage.extname)
+        if(self.compositing):
+            self.d.composite_query_version()
+            self.d.damage_query_version()
+            self.DAMAGE_NOTIFY = self.d.extension_event.DamageNotify
+        else:
+            logger.info("Composite or Damage extension missing, Alt+Tab switcher will show titles only")
+
+    def track_damage(self, record):
+        if(not self.compositing):
+            return
+        toplevel = record.toplevel()
+        toplevel.composite_redirect_window(composite.RedirectAutomatic)
+        record.damage = toplevel.damage_create(damage.DamageReportNonEmpty)
+
+    def handle_damage_notify(self, event):
+        record = self.registry.get(event.drawable.id)
+        if(record):
+            # No damage_subtract here: NonEmpty reports once until the thumbnail is refreshed
+            self.thumbnails.invalidate(record.client.id)
+
+    def capture_thumbnail(self, record):
+        if(record.damage is None):
+            # Unredirected while fullscreen, keep the last thumbnail
+            return
+        toplevel = record.toplevel()
+        try:
+            self.d.damage_subtract(record.damage)
+            geom = toplevel.get_geometry()
+            pixmap = toplevel.composite_name_window_pixmap()
+            try:
+                image = pixmap.get_image(0, 0, geom.width, geom.height, X.ZPixmap, 0xffffffff)
+            finally:
+                pixmap.free()
+        except Exception as e:
+            logger.debug(f"Could not capture thumbnail of {toplevel.id}: {e}")
+            return
+
+        if(len(image.data) != geom.width * geom.height * 4):
+            logger.debug(f"Skipping thumbnail of {toplevel.id}: not 32 bits per pixel")
+            return
+
+        # Nearest neighbour by slicing whole rows with a fixed stride
+        step = max(1, math.ceil(max(geom.width / self.thumbnail_width, geom.height / self.thumbnail_height)))
+        pixels = array("I", image.data)
+        scaled = array("I")
+        for y in range(0, geom.height, step):
+            scaled.extend(pixels[y * geom.width:(y + 1) * geom.width:step])
+        width = len(range(0, geom.width, step))
+        height = len(range(0, geom.height, step))
+
+        thumbnail = self.root.create_pixmap(width, height, self.screen.root_depth)
+        thumbnail.put_image(self.switcher_background_color, 0, 0, width, height, X.ZPixmap, self.screen.root_depth, 0, scaled.tobytes())
+        self.thumbnails.put(record.client.id, thumbnail, width, height)
+
+    def alt_held(self):
+        keymap = self.d.query_keymap()
+        for keycode in self.d.get_modifier_mapping()[X.Mod1MapIndex]:
+            if(keycode and keymap[keycode // 8] & (1 << (keycode % 8))):
+                return True
+        return False
+
+    def open_switcher(self):
+        self.switcher_windows = list(self.registry.stack(self.current_workspace))
+        active = self.active_frame[self.current_workspace]
+        if(active and active.id in self.switcher_windows):
+            self.switcher_selection = self.switcher_windows.index(active.id)
+        else:
+            self.switcher_selection = 0
+
+        if(self.compositing):
+            for win_id in self.switcher_windows:
+                record = self.registry.get(win_id)
+                if(record.state == "max" and self.thumbnails.needs_refresh(win_id)):
+                    self.capture_thumbnail(record)
+
+        self.root.grab_keyboard(True, X.GrabModeAsync, X.GrabModeAsync, X.CurrentTime)
+        self.switcher_active = True
+
+        columns, rows = self.switcher_grid()
+        cell_width, cell_height = self.switcher_cell_size()
+        width = columns * cell_width
+        height = rows * cell_height
+        self.switcher.configure(
+            x=(self.screen.width_in_pixels - width) // 2,
+            y=(self.screen.height_in_pixels - height) // 2,
+            width=width,
+            height=height,
+            stack_mode=X.Above
+        )
+        self.switcher.map()
+
+    def close_switcher(self, commit):
+        self.switcher_active = False
+        self.switcher.unmap()
+        self.d.ungrab_keyboard(X.CurrentTime)
+        if(commit and self.switcher_windows):
+            win = self.fetch_win_using_id(self.switcher_windows[self.switcher_selection])
+            if(win):
+                self.set_active_frame(win)
+        self.switcher_windows = []
+
+    def switcher_cell_size(self):
+        return self.thumbnail_width + 20, self.thumbnail_height + 40
+
+    def switcher_grid(self):
+        cell_width, cell_height = self.switcher_cell_size()
+        n = len(self.switcher_windows)
+        columns = max(1, min(n, self.screen.width_in_pixels // cell_width))
+        rows = max(1, -(-n // columns))
+        return columns, rows
+
+    def draw_switcher(self):
+        if(not self.switcher_active):
+            return
+        columns, rows = self.switcher_grid()
+        cell_width, cell_height = self.switcher_cell_size()
+        self.switcher.fill_rectangle(self.switcher_background_color, 0, 0, columns * cell_width, rows * cell_height)
+
+        for index, win_id in enumerate(self.switcher_windows):
+            win = self.fetch_win_using_id(win_id)
+            if(not win):
+                continue
+            x = (index % columns) * cell_width + 10
+            y = (index // columns) * cell_height + 10
+            if(index == self.switcher_selection):
+                self.switcher.fill_rectangle(self.button_active_background_color, x - 5, y - 5, cell_width - 10, cell_height - 10)
+                font_color = self.button_active_font_color
+            else:
+                font_color = self.button_passive_font_color
+
+            entry = self.thumbnails.get(win_id)
+            if(entry):
+                pixmap, width, height = entry
+                self.switcher.copy_area(self.switcher_background_color, pixmap, 0, 0, width, height,
+                    x + (self.thumbnail_width - width) // 2, y + (self.thumbnail_height - height) // 2)
+            else:
+                self.switcher.fill_rectangle(self.button_passive_background_color, x, y, self.thumbnail_width, self.thumbnail_height)
+            self.switcher.draw_text(font_color, x, y + self.thumbnail_height + 20, self.text.fit(self.get_window_title(win), self.thumbnail_width))
+
+    def set_root_property(self, atom, prop_type, value):
+        self.net_pending[atom] = (prop_type, value)
+
+    def ewmh_add_client(self, win_id):
+        self.net_client_list.append(win_id)
+        if(not self.net_client_list_rewrite):
+            self.net_client_list_appended.append(win_id)
+
+    def ewmh_remove_client(self, win_id):
+        if(win_id not in self.net_client_list):
+            return
+        self.net_client_list.remove(win_id)
+        if(win_id in self.net_client_list_appended):
+            self.net_client_list_appended.remove(win_id)
+        else:
+            # X has no way to drop a single entry, the list has to be rewritten
+            self.net_client_list_rewrite = True
+            self.net_client_list_appended = []
+
+    def update_ewmh(self):
+        if(self.net_client_list_rewrite):
+            self.root.change_property(self.NET_CLIENT_LIST, Xatom.WINDOW, 32, self.net_client_list)
+        elif(self.net_client_list_appended):
+            self.root.change_property(self.NET_CLIENT_LIST, Xatom.WINDOW, 32, self.net_client_list_appended, X.PropModeAppend)
+        self.net_client_list_rewrite = False
+        self.net_client_list_appended = []
+
+        for atom, (prop_type, value) in self.net_pending.items():
+            if(self.net_published.get(atom) == value):
+                continue
+            self.root.change_property(atom, prop_type, 32, [value])
+            self.net_published[atom] = value
+        self.net_pending = {}
+
+    def activate_window(self, win_id):
+        record = self.registry.get(win_id)
+        if not record:
+            return
+        self.switch_workspace(record.workspace)
+        record.state = "max"
+        self.set_active_frame(record.client)
 
     def fetch_win_using_id(self, win_id):
-        if(win_id in self.borderless_windows):
-            return self.borderless_windows[win_id]
-        
-        if(win_id in self.client_to_frame):
-            return self.frame_to_client[self.client_to_frame[win_id].id]
+        record = self.registry.get(win_id)
+        if(record):
+            return record.client
 
     def set_frame_window_buttons(self, frame_id):
-        if(frame_id in self.borderless_windows):
+        record = self.registry.get(frame_id)
+        if(not record or record.borderless):
             return
-        win = self.frame_to_client[frame_id]
-        geom = win.get_geometry()
+        geom = self.batch.geometry(record.client)
         frame_width = geom.width - 1
         
         for index in range(3):
-            self.frame_to_button_mapping[self.client_to_frame[win.id].id][index].configure(
+            self.batch.configure(
+                record.buttons[index],
                 x = frame_width - ((index+1)*self.frame_border_width),
                 y = 0
             )
@@ -189,80 +1420,83 @@ class SimplePyWM:
     def switch_workspace(self, workspace_id):
         if(workspace_id == self.current_workspace):
             return
-        
+        if(self.switcher_active):
+            # Its entries belong to the workspace being left
+            self.close_switcher(False)
 
         old_workspace = self.current_workspace
         self.current_workspace = workspace_id
 
-        if(self.current_workspace not in self.workspaces):
+        if(self.current_workspace not in self.registry.stacks):
             self.active_frame[self.current_workspace] = None
-            self.window_stack[self.current_workspace] = []
-            self.workspaces[self.current_workspace] = {}
-        if(not len(self.workspaces[self.current_workspace])):
-            self.root.set_input_focus(X.RevertToPointerRoot, X.CurrentTime)
-            self.d.flush()
-
-        for win_id in self.workspaces[old_workspace]:
-            if(win_id in self.borderless_windows):
-                self.borderless_windows[win_id].unmap()
-            else:
-                self.frame_to_client[self.client_to_frame[win_id].id].unmap()
+        if(not len(self.registry.stack(self.current_workspace))):
+            self.batch.set_input_focus(self.root, X.RevertToPointerRoot)
+            self.focused_window = None
+
+        for win_id in self.registry.stack(old_workspace):
+            self.batch.unmap(self.registry.get(win_id).client)
         
-        for win_id in self.workspaces[self.current_workspace]:
-            logger.info(f"Mapping {win_id} with {self.workspaces[self.current_workspace][win_id]}")
-            if(self.workspaces[self.current_workspace][win_id] == "max"):
-                if(win_id in self.borderless_windows):
-                    self.borderless_windows[win_id].map()
-                else:
-                    self.client_to_frame[win_id].map()
-                    self.frame_to_client[self.client_to_frame[win_id].id].map()
+        for win_id in self.registry.stack(self.current_workspace):
+            record = self.registry.get(win_id)
+            logger.info(f"Mapping {win_id} with {record.state}")
+            if(record.state == "max"):
+                if(not record.borderless):
+                    self.batch.map(record.frame)
+                self.batch.map(record.client)
         if(self.active_frame[self.current_workspace]):
             self.set_active_frame(self.active_frame[self.current_workspace])
+        else:
+            self.set_root_property(self.NET_ACTIVE_WINDOW, Xatom.WINDOW, X.NONE)
 
-    def maximize_window(self, win):
-        borderless = 0
-        if(win.id in self.borderless_windows):
-            borderless = 1
+        self.set_root_property(self.NET_CURRENT_DESKTOP, Xatom.CARDINAL, self.current_workspace - 1)
+        self.set_root_property(self.NET_NUMBER_OF_DESKTOPS, Xatom.CARDINAL, max(self.registry.stacks))
 
-        if(borderless):
-            frame = self.borderless_windows[win.id]
-        else:
-            frame = self.client_to_frame.get(win.id)
-        if not frame:
+    def maximize_window(self, win):
+        record = self.registry.get(win.id)
+        if not record or record.fullscreen is not None:
             return
+        borderless = record.borderless
+        frame = record.toplevel()
 
         screen_width = self.screen.width_in_pixels
         screen_height = self.screen.height_in_pixels
         border = self.frame_border_width
 
-        geom = frame.get_geometry()
-        geom_win = win.get_geometry()
+        geom = self.batch.geometry(frame)
+        geom_win = geom if borderless else self.batch.geometry(win)
         if((geom.width == screen_width) and (geom.height == screen_height - self.taskbar_height)):
-            if(frame.id not in self.old_x_y_width_height):
-                frame.configure(
+            if(not record.saved_geometry):
+                self.batch.configure(
+                    frame,
                     x=0, y=0
                 )
                 return
-            frame.configure(
-                x=self.old_x_y_width_height[frame.id][0],
-                y=self.old_x_y_width_height[frame.id][1],
-                width=self.old_x_y_width_height[frame.id][2],
-                height=self.old_x_y_width_height[frame.id][3]
-            )
-            win.configure(
-                x=self.old_x_y_width_height[win.id][0],
-                y=self.old_x_y_width_height[win.id][1],
-                width=self.old_x_y_width_height[win.id][2],
-                height=self.old_x_y_width_height[win.id][3]
+            frame_geom, client_geom = record.saved_geometry
+            self.batch.configure(
+                frame,
+                x=frame_geom[0],
+                y=frame_geom[1],
+                width=frame_geom[2],
+                height=frame_geom[3]
             )
             if(not borderless):
+                self.batch.configure(
+                    win,
+                    x=client_geom[0],
+                    y=client_geom[1],
+                    width=client_geom[2],
+                    height=client_geom[3]
+                )
                 self.set_frame_window_buttons(frame.id)
             return
 
-        self.old_x_y_width_height[frame.id] = (geom.x, geom.y, geom.width, geom.height)
-        self.old_x_y_width_height[win.id] = (geom_win.x, geom_win.y, geom_win.width, geom_win.height)
+        record.saved_geometry = (
+            (geom.x, geom.y, geom.width, geom.height),
+            (geom_win.x, geom_win.y, geom_win.width, geom_win.height)
+        )
 
-        frame.configure(
+        self.batch.configure(
+            frame,
             x=0,
             y=0,
             width=screen_width,
@@ -271,7 +1505,8 @@ class SimplePyWM:
         if(not borderless):
             top = border
             height = screen_height - 1 - border - self.taskbar_height
-            win.configure(
+            self.batch.configure(
+                win,
                 x=1,
                 y=top,
                 width=screen_width - 2,
@@ -282,22 +1517,120 @@ class SimplePyWM:
 
 
     def get_window_title(self, win):
+        record = self.registry.get(win.id)
+        if(record and "title" in record.properties):
+            return record.properties["title"]
+        return "Unknown"
+
+    def request_properties(self, win_id, reason):
+        if(self.fetcher):
+            self.fetcher.fetch(win_id, reason)
+        else:
+            self.properties_fetched(win_id, reason, fetch_window_properties(self.d, win_id, self.property_atoms))
+
+    def handle_fetched_properties(self):
         try:
-            win_obj = self.d.create_resource_object('window', win)
-            wm_class = win_obj.get_wm_class()
-            if wm_class and len(wm_class) > 1:
-                return wm_class[1]
-            elif wm_class:
-                return wm_class[0]
+            os.read(self.wake_read, 4096)
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                win_id, reason, properties = self.fetcher.results.get_nowait()
+            except queue.Empty:
+                break
+            self.properties_fetched(win_id, reason, properties)
+        self.update_taskbar_visibility()
+        self.draw_taskbar()
+        self.update_ewmh()
+        self.batch.flush()
+
+    def properties_fetched(self, win_id, reason, properties):
+        if(reason == "map"):
+            win = self.pending_maps.pop(win_id, None)
+            if(win is None or properties is None):
+                return
+            self.manage_window(win, properties)
+            self.clear_taskbar()
+        elif(properties is not None):
+            record = self.registry.get(win_id)
+            if(record):
+                record.properties.update(properties)
+
+    def set_fullscreen(self, record, enabled):
+        if(enabled == (record.fullscreen is not None)):
+            return
+        win = record.client
+        toplevel = record.toplevel()
+
+        if(enabled):
+            client_geom = self.batch.geometry(win)
+            frame_geom = None
+            if(not record.borderless):
+                geom = self.batch.geometry(record.frame)
+                frame_geom = (geom.x, geom.y, geom.width, geom.height)
+            record.fullscreen = (frame_geom, (client_geom.x, client_geom.y, client_geom.width, client_geom.height, client_geom.border_width))
+
+            width = self.screen.width_in_pixels
+            height = self.screen.height_in_pixels
+            self.batch.configure(toplevel, x=0, y=0, width=width, height=height)
+            if(not record.borderless):
+                # The client covers the whole frame, decorations included. Pointer motion
+                # and the frame's resize cursors would only get in the way
+                self.batch.configure(win, x=0, y=0, width=width, height=height, border_width=0)
+                self.batch.change_attributes(record.frame, event_mask=FRAME_EVENT_MASK & ~X.PointerMotionMask, cursor=self.cursor_default)
             else:
-                return "Unknown"
-        except Exception as e:
-            return "Unknown"
+                self.batch.configure(win, border_width=0)
+            win.change_property(self.NET_WM_STATE, Xatom.ATOM, 32, [self.NET_WM_STATE_FULLSCREEN])
+            if(self.compositing):
+                # Let the client draw straight to the screen, nothing needs thumbnails of it meanwhile
+                toplevel.composite_unredirect_window(composite.RedirectAutomatic)
+                self.d.damage_destroy(record.damage)
+                record.damage = None
+                self.thumbnails.invalidate(win.id)
+            if(record.workspace == self.current_workspace):
+                self.raise_window(toplevel.id)
+        else:
+            frame_geom, client_geom = record.fullscreen
+            record.fullscreen = None
+            x, y, width, height, border_width = client_geom
+            self.batch.configure(win, x=x, y=y, width=width, height=height, border_width=border_width)
+            if(not record.borderless):
+                x, y, width, height = frame_geom
+                self.batch.configure(record.frame, x=x, y=y, width=width, height=height)
+                self.batch.change_attributes(record.frame, event_mask=FRAME_EVENT_MASK)
+            win.change_property(self.NET_WM_STATE, Xatom.ATOM, 32, [])
+            self.track_damage(record)
+            if(record.workspace == self.current_workspace):
+                self.raise_window(toplevel.id)
+        logger.info(f"Fullscreen {'on' if enabled else 'off'} for {win.id}")
+
+    def update_taskbar_visibility(self):
+        # The taskbar stays out of the way, unmapped and left out of stacking, while the
+        # active window of the current workspace is fullscreen
+        active = self.active_frame.get(self.current_workspace)
+        record = self.registry.get(active.id) if active else None
+        hidden = bool(record and record.fullscreen is not None and record.state == "max")
+        if(hidden == self.taskbar_hidden):
+            return
+        self.taskbar_hidden = hidden
+        if(hidden):
+            self.batch.unmap(self.taskbar)
+            self.forget_stacking(self.taskbar.id)
+        else:
+            # Redrawn after the Expose that follows
+            self.batch.map(self.taskbar)
+            self.raise_window(self.taskbar.id)
+
+    def clear_taskbar(self):
+        if(not self.taskbar_hidden):
+            self.taskbar.clear_area()
 
     def draw_taskbar(self):
+        if(self.taskbar_hidden):
+            return
 
         width = self.screen.width_in_pixels - config["display"]["window"]["taskbar"]["workspace_width"] - config["display"]["window"]["taskbar"]["polybar_width"]
-        n = len(self.window_stack[self.current_workspace])
+        n = len(self.registry.stack(self.current_workspace))
 
         self.taskbar.fill_rectangle(self.button_passive_background_color, self.button_border_width , self.button_border_width , config["display"]["window"]["taskbar"]["workspace_width"] - 2*self.button_border_width, self.taskbar_height - 2*self.button_border_width)
         self.taskbar.draw_text(self.button_passive_font_color, 6, self.taskbar_height // 2 + 5, str(self.current_workspace))
@@ -309,9 +1642,9 @@ class SimplePyWM:
         btn_width = width // n
 
         counter = 0
-        for client_id in self.window_stack[self.current_workspace]:
+        for client_id in self.registry.stack(self.current_workspace):
             client = self.fetch_win_using_id(client_id)
-            win_title = self.get_window_title(client)
+            win_title = self.text.fit(self.get_window_title(client), btn_width - 12)
             x = (counter * btn_width) + config["display"]["window"]["taskbar"]["workspace_width"]
             counter += 1
 
@@ -319,24 +1652,28 @@ class SimplePyWM:
 
             if(self.active_frame[self.current_workspace] == client):
                 self.taskbar.fill_rectangle(self.button_active_background_color, x+self.button_border_width , self.button_border_width , btn_width - 2*self.button_border_width, self.taskbar_height - 2*self.button_border_width)
-                self.taskbar.draw_text(self.button_active_font_color, x + 6, self.taskbar_height // 2 + 5, win_title[:20])
+                self.taskbar.draw_text(self.button_active_font_color, x + 6, self.taskbar_height // 2 + 5, win_title)
             else:
                 self.taskbar.fill_rectangle(self.button_passive_background_color, x+self.button_border_width , self.button_border_width , btn_width - 2*self.button_border_width, self.taskbar_height - 2*self.button_border_width)
-                self.taskbar.draw_text(self.button_passive_font_color, x + 6, self.taskbar_height // 2 + 5, win_title[:20])
+                self.taskbar.draw_text(self.button_passive_font_color, x + 6, self.taskbar_height // 2 + 5, win_title)
 
     def cycle_windows(self, backwards=False):
-        if not self.window_stack[self.current_workspace]:
+        if not self.registry.stack(self.current_workspace):
             return
 
-        idx = self.window_stack[self.current_workspace].index(self.active_frame[self.current_workspace].id)
+        # Only the switcher is redrawn while Alt is held, focus moves once Alt is released
+        opened = not self.switcher_active
+        if(opened):
+            self.open_switcher()
 
         if backwards:
-            new_idx = (idx - 1) % len(self.window_stack[self.current_workspace])
+            self.switcher_selection = (self.switcher_selection - 1) % len(self.switcher_windows)
         else:
-            new_idx = (idx + 1) % len(self.window_stack[self.current_workspace])
+            self.switcher_selection = (self.switcher_selection + 1) % len(self.switcher_windows)
+        self.draw_switcher()
 
-        next_frame = self.window_stack[self.current_workspace][new_idx]
-        self.set_active_frame(self.fetch_win_using_id(next_frame))
+        if(opened and not self.alt_held()):
+            self.close_switcher(True)
 
     def set_active_frame(self, win):
         if(self.taskbar == win):
@@ -344,201 +1681,294 @@ class SimplePyWM:
 
         if self.active_frame[self.current_workspace] and self.active_frame[self.current_workspace] != win:
             try:
-                if(self.active_frame[self.current_workspace].id not in self.borderless_windows):
-                    self.client_to_frame[self.active_frame[self.current_workspace].id].change_attributes(background_pixel=self.passive_background_color)
-                    self.client_to_frame[self.active_frame[self.current_workspace].id].clear_area()
+                previous = self.registry.get(self.active_frame[self.current_workspace].id)
+                if(previous):
+                    self.paint_frame(previous, False)
             except Exception as e:
                 logger.warning(f"Failed to deactivate previous frame: {e}")
 
         self.active_frame[self.current_workspace] = win
+        self.set_root_property(self.NET_ACTIVE_WINDOW, Xatom.WINDOW, win.id)
 
         try:
-            borderless = 0
-            if(self.active_frame[self.current_workspace].id in self.borderless_windows):
-                borderless = 1
-            win.map()
-            if(not borderless):
-                self.client_to_frame[win.id].map()
-                self.client_to_frame[win.id].change_attributes(background_pixel=self.active_background_color)
-                self.client_to_frame[win.id].clear_area()
-                self.client_to_frame[win.id].configure(stack_mode=X.Above)
-            else:
-                win.configure(stack_mode=X.Above)
-            win.set_input_focus(X.RevertToParent, X.CurrentTime)
+            record = self.registry.get(win.id)
+            self.batch.map(win)
+            if(not record.borderless):
+                self.batch.map(record.frame)
+            self.paint_frame(record, True)
+            self.occupy(record)
+            self.raise_window(record.toplevel().id)
+            if(self.focused_window != win.id):
+                self.batch.set_input_focus(win, X.RevertToParent)
+                self.focused_window = win.id
             logger.debug(f"Set frame {win.id} as active and raised")
         except Exception as e:
             logger.warning(f"Failed to set active frame: {e}")
-        
-        self.taskbar.configure(stack_mode=X.Above)
 
+    def paint_frame(self, record, active):
+        if(record.borderless or record.active == active):
+            return
+        if(active):
+            self.batch.change_attributes(record.frame, background_pixel=self.active_background_color)
+        else:
+            self.batch.change_attributes(record.frame, background_pixel=self.passive_background_color)
+        self.batch.clear_area(record.frame)
+        record.active = active
+
+    def window_layer(self, win_id):
+        if(win_id == self.taskbar.id):
+            return 2
+        record = self.registry.get(win_id)
+        if(record and record.fullscreen is not None and self.active_frame.get(self.current_workspace) == record.client):
+            # The active fullscreen window covers everything, "above" windows included
+            return 3
+        if(record and record.layer == "above"):
+            return 1
+        return 0
+
+    def raise_window(self, win_id):
+        order = [stacked_id for stacked_id in self.stacking if stacked_id != win_id]
+        order.append(win_id)
+        order.sort(key=self.window_layer)
+        self.restack_windows(order)
+
+    def forget_stacking(self, win_id):
+        if(win_id in self.stacking):
+            self.stacking.remove(win_id)
+
+    def restack_windows(self, order):
+        if(order == self.stacking):
+            return
 
-    def grab_shortcut(self):
-        key_sym = XK.string_to_keysym('T')
-        key_code = self.d.keysym_to_keycode(key_sym)
-
-        modifiers = X.ControlMask | X.ShiftMask
-
-        self.root.grab_key(key_code, modifiers, True, X.GrabModeAsync, X.GrabModeAsync)
+        # Windows forming the longest run already in the right relative order stay put,
+        # every other one is placed right above its new lower neighbour
+        position = {win_id: index for index, win_id in enumerate(self.stacking)}
+        tails = []
+        tail_ids = []
+        previous = {}
+        for win_id in order:
+            if(win_id not in position):
+                continue
+            index = bisect.bisect_left(tails, position[win_id])
+            previous[win_id] = tail_ids[index - 1] if index else None
+            if(index == len(tails)):
+                tails.append(position[win_id])
+                tail_ids.append(win_id)
+            else:
+                tails[index] = position[win_id]
+                tail_ids[index] = win_id
+        keep = set()
+        win_id = tail_ids[-1] if tail_ids else None
+        while win_id is not None:
+            keep.add(win_id)
+            win_id = previous[win_id]
+
+        for index, win_id in enumerate(order):
+            if(win_id in keep):
+                continue
+            win = self.d.create_resource_object('window', win_id)
+            if(index > 0):
+                self.batch.configure(win, sibling=order[index - 1], stack_mode=X.Above)
+            elif(keep):
+                self.batch.configure(win, sibling=next(kept for kept in order if kept in keep), stack_mode=X.Below)
+            else:
+                self.batch.configure(win, stack_mode=X.Above)
+        self.stacking = list(order)
+
+
+    def compile_keybindings(self):
+        self.root.ungrab_key(X.AnyKey, X.AnyModifier)
+
+        # Grabs and lookups ignore NumLock and CapsLock
+        numlock_mask = 0
+        numlock_keycode = self.d.keysym_to_keycode(XK.XK_Num_Lock)
+        for index, keycodes in enumerate(self.d.get_modifier_mapping()):
+            if(numlock_keycode and numlock_keycode in keycodes):
+                numlock_mask = 1 << index
+        lock_masks = {0, X.LockMask, numlock_mask, X.LockMask | numlock_mask}
+        self.modifier_mask = (X.ShiftMask | X.ControlMask | X.Mod1Mask | X.Mod2Mask | X.Mod3Mask | X.Mod4Mask | X.Mod5Mask) & ~numlock_mask
+        self.escape_keycode = self.d.keysym_to_keycode(XK.XK_Escape)
+
+        actions = {
+            "spawn": self.spawn,
+            "quit": quit,
+            "switch_workspace": self.switch_workspace,
+            "cycle_windows": self.cycle_windows,
+            "snap": self.snap_active_window
+        }
 
-        for key_sym in [XK.XK_Left, XK.XK_Right, XK.XK_Up, XK.XK_Down]:
-            key_code = self.d.keysym_to_keycode(key_sym)
-            self.root.grab_key(key_code, X.ControlMask, True,  X.GrabModeAsync, X.GrabModeAsync)
-        
-        key_code = self.d.keysym_to_keycode(XK.string_to_keysym('Q'))
-        self.root.grab_key(key_code, X.Mod4Mask, True,  X.GrabModeAsync, X.GrabModeAsync)
+        self.keybindings = {}
+        for binding in config["keybindings"]:
+            keycode = self.d.keysym_to_keycode(XK.string_to_keysym(binding["key"]))
+            if(not keycode or binding["action"] not in actions):
+                logger.warning(f"Skipping keybinding {binding}: unknown key or action")
+                continue
+            if(any(name not in MODIFIER_MASKS for name in binding.get("modifiers", []))):
+                logger.warning(f"Skipping keybinding {binding}: unknown modifier")
+                continue
+            modifiers = 0
+            for name in binding.get("modifiers", []):
+                modifiers |= MODIFIER_MASKS[name]
+            self.keybindings[(keycode, modifiers)] = (actions[binding["action"]], binding.get("args", []))
+            for lock_mask in lock_masks:
+                self.root.grab_key(keycode, modifiers | lock_mask, True, X.GrabModeAsync, X.GrabModeAsync)
+
+    def handle_mapping_notify(self, event):
+        self.d.refresh_keyboard_mapping(event)
+        if event.request in (X.MappingKeyboard, X.MappingModifier):
+            self.compile_keybindings()
 
-        key_code = self.d.keysym_to_keycode(XK.string_to_keysym('E'))
-        self.root.grab_key(key_code, X.ControlMask, True,  X.GrabModeAsync, X.GrabModeAsync)
+    def handle_key_press(self, event):
+        if self.switcher_active and event.detail == self.escape_keycode:
+            self.close_switcher(False)
+            return
 
-        key_code = self.d.keysym_to_keycode(XK.XK_space)
-        self.root.grab_key(key_code, X.ControlMask, True,  X.GrabModeAsync, X.GrabModeAsync)
+        binding = self.keybindings.get((event.detail, event.state & self.modifier_mask))
+        if binding:
+            action, args = binding
+            if(self.switcher_active and action != self.cycle_windows):
+                # The keyboard belongs to the switcher until it is committed or cancelled
+                return
+            action(*args)
 
-        key_code = self.d.keysym_to_keycode(XK.XK_Tab)
-        self.root.grab_key(key_code, X.Mod1Mask, True, X.GrabModeAsync, X.GrabModeAsync)
-        self.root.grab_key(key_code, X.Mod1Mask | X.ShiftMask, True, X.GrabModeAsync, X.GrabModeAsync)
+    def spawn(self, command):
+        try:
+            if(isinstance(command, str)):
+                # A name from "commands", otherwise a command line split like a shell would
+                command = config["commands"].get(command) or shlex.split(command)
+            subprocess.Popen(command)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not spawn {command}: {e}")
+
+    def snap_active_window(self, direction):
+        if not self.active_frame[self.current_workspace]:
+            return
 
-        for i in range(1, 9):
-            self.root.grab_key(
-                self.d.keysym_to_keycode(getattr(XK, f"XK_{i}")), X.Mod4Mask, True,
-                X.GrabModeAsync, X.GrabModeAsync
-            )
+        geom = self.screen.root.get_geometry()
+        screen_width = geom.width
+        screen_height = geom.height
 
-    def handle_key_press(self, event):
-        key_sym = self.d.keycode_to_keysym(event.detail, 1)
-        key_sym2 = self.d.keycode_to_keysym(event.detail, 0)
-
-        if event.state & X.Mod4Mask:
-            if key_sym2 in (XK.XK_1, XK.XK_2, XK.XK_3, XK.XK_4, XK.XK_5, XK.XK_6, XK.XK_7, XK.XK_8, XK.XK_9):
-                ws = int(chr(key_sym2))
-                self.switch_workspace(ws)
-            if key_sym == XK.XK_Q:
-                quit()
-        
-        if event.state & X.ControlMask:
-            if key_sym == XK.string_to_keysym('T') and event.state & X.ShiftMask:
-                subprocess.Popen(config["commands"]["terminal"])
-            if key_sym == XK.XK_E:
-                subprocess.Popen(config["commands"]["filemanager"])
-            if key_sym2 == XK.XK_space:
-                subprocess.Popen(config["commands"]["launcher"])
-
-        if event.state & X.Mod1Mask:
-            if key_sym2 == XK.XK_Tab:
-                backwards = bool(event.state & X.ShiftMask)
-                self.cycle_windows(backwards)
+        frame_border = self.frame_border_width
 
-        if not self.active_frame[self.current_workspace]:
+        record = self.registry.get(self.active_frame[self.current_workspace].id)
+        if(not record or record.fullscreen is not None):
+            return
+        if(record.borderless):
+            frame_border = 0
+        frame = record.toplevel()
+        if not frame:
             return
-        
-        if event.state & X.ControlMask:
-            geom = self.screen.root.get_geometry()
-            screen_width = geom.width
-            screen_height = geom.height
-
-            frame_border = self.frame_border_width
 
-            if(self.active_frame[self.current_workspace].id in self.borderless_windows):
-                frame_border = 0
-                frame = self.active_frame[self.current_workspace]
-            else:
-                frame = self.client_to_frame[self.active_frame[self.current_workspace].id]
+        if direction == "left":
+            self.batch.configure(
+                frame,
+                x=0,
+                y=0,
+                width=screen_width // 2,
+                height=screen_height - self.taskbar_height
+            )
+            if(frame_border):
+                self.batch.configure(
+                    self.active_frame[self.current_workspace],
+                    x=1,
+                    y=frame_border,
+                    width=(screen_width // 2) - 2,
+                    height=screen_height - 1 - frame_border - self.taskbar_height
+            )
 
-            if not frame:
-                return
-            
-            if key_sym2 == XK.XK_Left:
-                frame.configure(
-                    x=0,
-                    y=0,
-                    width=screen_width // 2,
-                    height=screen_height - self.taskbar_height
-                )
-                if(frame_border):
-                    self.active_frame[self.current_workspace].configure(
-                        x=1,
-                        y=frame_border,
-                        width=(screen_width // 2) - 2,
-                        height=screen_height - 1 - frame_border - self.taskbar_height
+        elif direction == "right":
+            self.batch.configure(
+                frame,
+                x=screen_width // 2,
+                y=0,
+                width=screen_width // 2,
+                height=screen_height - self.taskbar_height
+            )
+            if(frame_border):
+                self.batch.configure(
+                    self.active_frame[self.current_workspace],
+                    x=1,
+                    y=frame_border,
+                    width=(screen_width // 2) - 2,
+                    height=screen_height - 1 - frame_border - self.taskbar_height
                 )
 
-            elif key_sym2 == XK.XK_Right:
-                frame.configure(
-                    x=screen_width // 2,
-                    y=0,
-                    width=screen_width // 2,
-                    height=screen_height - self.taskbar_height
-                )
-                if(frame_border):
-                    self.active_frame[self.current_workspace].configure(
-                        x=1,
-                        y=frame_border,
-                        width=(screen_width // 2) - 2,
-                        height=screen_height - 1 - frame_border - self.taskbar_height
-                    )
-
-            elif key_sym2 == XK.XK_Up:
-                frame.configure(
-                    x=0,
-                    y=0,
-                    width=screen_width,
-                    height=screen_height // 2
+        elif direction == "up":
+            self.batch.configure(
+                frame,
+                x=0,
+                y=0,
+                width=screen_width,
+                height=screen_height // 2
+            )
+            if(frame_border):
+                self.batch.configure(
+                    self.active_frame[self.current_workspace],
+                    x=1,
+                    y=frame_border,
+                    width=screen_width - 2,
+                    height=(screen_height // 2) - 1 - frame_border
                 )
-                if(frame_border):
-                    self.active_frame[self.current_workspace].configure(
-                        x=1,
-                        y=frame_border,
-                        width=screen_width - 2,
-                        height=(screen_height // 2) - 1 - frame_border
-                    )
-
-            elif key_sym2 == XK.XK_Down:
-                frame.configure(
-                    x=0,
-                    y=screen_height // 2,
-                    width=screen_width,
-                    height=screen_height // 2 - self.taskbar_height
+
+        elif direction == "down":
+            self.batch.configure(
+                frame,
+                x=0,
+                y=screen_height // 2,
+                width=screen_width,
+                height=screen_height // 2 - self.taskbar_height
+            )
+            if(frame_border):
+                self.batch.configure(
+                    self.active_frame[self.current_workspace],
+                    x=1,
+                    y=frame_border,
+                    width=screen_width - 2,
+                    height=(screen_height // 2) - 1 - frame_border - self.taskbar_height
                 )
-                if(frame_border):
-                    self.active_frame[self.current_workspace].configure(
-                        x=1,
-                        y=frame_border,
-                        width=screen_width - 2,
-                        height=(screen_height // 2) - 1 - frame_border - self.taskbar_height
-                    )
-            if(frame_border != 0):
-                self.set_frame_window_buttons(frame.id)
+        if(frame_border != 0):
+            self.set_frame_window_buttons(frame.id)
+
+    def handle_key_release(self, event):
+        if not self.switcher_active:
+            return
+        key_sym = self.d.keycode_to_keysym(event.detail, 0)
+        if key_sym in (XK.XK_Alt_L, XK.XK_Alt_R, XK.XK_Meta_L, XK.XK_Meta_R):
+            self.close_switcher(True)
 
     def handle_button_press(self, event):
         if event.detail != 1:
             return
 
-        if(event.window.id in self.frame_window_buttons):
-            obj = self.frame_window_buttons.get(event.window.id)
-            action, target_win = obj
+        record = self.registry.get(event.window.id)
+        action = record.button_action(event.window.id) if record else None
+        if(action):
             if action == "close":
-                target_win.destroy()
+                record.frame.destroy()
             elif action == "maximize":
-                self.maximize_window(self.frame_to_client[target_win.id])
+                self.maximize_window(record.client)
             elif action == "minimize":
-                target_win.unmap()
+                self.batch.unmap(record.frame)
             return
 
         if event.window.id == self.taskbar.id:
             x = event.event_x
             for btn_x, client_id in self.taskbar_buttons:
-                if x >= btn_x and x < btn_x + (self.screen.width_in_pixels - config["display"]["window"]["taskbar"]["workspace_width"] - config["display"]["window"]["taskbar"]["polybar_width"]) // (len(self.window_stack[self.current_workspace])):
+                if x >= btn_x and x < btn_x + (self.screen.width_in_pixels - config["display"]["window"]["taskbar"]["workspace_width"] - config["display"]["window"]["taskbar"]["polybar_width"]) // (len(self.registry.stack(self.current_workspace))):
                     win = self.fetch_win_using_id(client_id)
                     self.set_active_frame(win)
                     break
             return
 
         frame = event.window
-        self.set_active_frame(self.frame_to_client[frame.id])
+        if(not record):
+            return
+        self.set_active_frame(record.client)
 
-        if(event.window.id in self.borderless_windows):
+        if(record.borderless or record.fullscreen is not None):
             return
 
-        geom = frame.get_geometry()
+        geom = self.batch.geometry(frame)
         frame_width = geom.width
         frame_height = geom.height
         margin = 10
@@ -582,14 +2012,22 @@ class SimplePyWM:
 
         if event.window.id == self.taskbar.id:
             return
+        record = self.registry.get(win.id)
+        if(record and record.fullscreen is not None):
+            return
 
         if not self.resizing and not self.dragging:
-            geom = win.get_geometry()
+            if(record and record.geometry and record.toplevel().id == win.id):
+                # Tracked from ConfigureNotify, saves a round trip per motion event
+                _, _, width, height = record.geometry
+            else:
+                geom = win.get_geometry()
+                width, height = geom.width, geom.height
             x, y = event.event_x, event.event_y
             margin = 10
 
-            near_right = x >= geom.width - margin
-            near_bottom = y >= geom.height - margin
+            near_right = x >= width - margin
+            near_bottom = y >= height - margin
 
             if near_right and near_bottom:
                 cursor = self.cursor_diag
@@ -600,13 +2038,13 @@ class SimplePyWM:
             else:
                 cursor = self.cursor_default
 
-            win.change_attributes(cursor=cursor)
+            self.batch.change_attributes(win, cursor=cursor)
         
         if self.resizing and self.resize_window:
             frame = self.resize_window
-            client = self.frame_to_client[frame.id]
+            record = self.registry.get(frame.id)
 
-            if not client:
+            if not record:
                 logger.warning(f"No client found for frame {frame.id}")
                 return
 
@@ -624,16 +2062,17 @@ class SimplePyWM:
             if self.resize_mode in ("vertical", "both"):
                 new_height = frame_geom.height + dy
 
-            frame.configure(width=new_width, height=new_height)
+            self.batch.configure(frame, width=new_width, height=new_height)
 
-            client.configure(width=new_width - 2, height=new_height - self.frame_border_width - 1)
+            if(not record.borderless):
+                self.batch.configure(record.client, width=new_width - 2, height=new_height - self.frame_border_width - 1)
 
         if self.dragging and self.drag_window:
             offset_x, offset_y = self.drag_start_pos
             new_x = event.root_x - offset_x
             new_y = event.root_y - offset_y
 
-            self.drag_window.configure(x=new_x, y=new_y)
+            self.batch.configure(self.drag_window, x=new_x, y=new_y)
 
     def handle_button_release(self, event):
         if self.dragging:
@@ -648,41 +2087,45 @@ class SimplePyWM:
 
         self.d.ungrab_pointer(X.CurrentTime)
 
-    def wants_no_border(self, win):
-        try:
-            # --- Motif Hints ---
-            motif_hints = self.d.intern_atom("_MOTIF_WM_HINTS")
-            prop = win.get_full_property(motif_hints, X.AnyPropertyType)
-            if prop:
-                hints = prop.value
-                if len(hints) >= 3:
-                    decorations = hints[2]
-                    if decorations == 0:
-                        return True
-        except Exception as e:
-            logger.debug(f"Motif hint check failed for {win.id}: {e}")
+    def wants_no_border(self, properties):
+        # --- Motif Hints ---
+        hints = properties["motif_hints"]
+        if len(hints) >= 3:
+            decorations = hints[2]
+            if decorations == 0:
+                return True
 
-        try:
-            # --- EWMH Window Types ---
-            NET_WM_WINDOW_TYPE = self.d.intern_atom("_NET_WM_WINDOW_TYPE")
-            NET_WM_WINDOW_TYPE_DIALOG = self.d.intern_atom("_NET_WM_WINDOW_TYPE_DIALOG")
-            NET_WM_WINDOW_TYPE_SPLASH = self.d.intern_atom("_NET_WM_WINDOW_TYPE_SPLASH")
-            NET_WM_WINDOW_TYPE_DOCK = self.d.intern_atom("_NET_WM_WINDOW_TYPE_DOCK")
-
-            prop = win.get_full_property(NET_WM_WINDOW_TYPE, X.AnyPropertyType)
-            if prop:
-                for t in prop.value:
-                    if t in (NET_WM_WINDOW_TYPE_DIALOG,
-                            NET_WM_WINDOW_TYPE_SPLASH,
-                            NET_WM_WINDOW_TYPE_DOCK):
-                        return True
-        except Exception as e:
-            logger.debug(f"EWMH type check failed for {win.id}: {e}")
+        # --- EWMH Window Types ---
+        return self.window_types_layer(properties["window_types"]) == "above"
 
-        return False
+    def window_types_layer(self, window_types):
+        for t in window_types:
+            if t in self.above_window_types:
+                return "above"
+        return "normal"
 
     def handle_client_message(self, event):
-        if(event.window.id not in self.borderless_windows):
+        if event.client_type == self.NET_CURRENT_DESKTOP:
+            desktop = event.data[1][0]
+            # CARD32, never negative. Stray values must not create workspaces
+            if(desktop < workspace_count):
+                self.switch_workspace(desktop + 1)
+            else:
+                logger.debug(f"Ignoring switch to desktop {desktop}")
+            return
+
+        if event.client_type == self.NET_ACTIVE_WINDOW:
+            self.activate_window(event.window.id)
+            return
+
+        record = self.registry.get(event.window.id)
+        if(record and event.client_type == self.NET_WM_STATE and self.NET_WM_STATE_FULLSCREEN in event.data[1][1:3]):
+            # 0 removes, 1 adds, 2 toggles
+            action = event.data[1][0]
+            self.set_fullscreen(record, action == 1 or (action == 2 and record.fullscreen is None))
+            return
+
+        if(not record or not record.borderless):
             return
         WM_PROTOCOLS = self.d.intern_atom("WM_PROTOCOLS")
         WM_DELETE_WINDOW = self.d.intern_atom("WM_DELETE_WINDOW")
@@ -731,7 +2174,7 @@ class SimplePyWM:
                 X.NONE, X.NONE, X.CurrentTime)
 
         if event.client_type == WM_CHANGE_STATE:
-            event.window.unmap()
+            self.batch.unmap(event.window)
 
         if event.client_type == WM_PROTOCOLS:
             if event.data[0] == WM_DELETE_WINDOW:
@@ -752,79 +2195,230 @@ class SimplePyWM:
 
     def run(self):
         while True:
+            if(self.fetcher and not self.d.pending_events()):
+                self.d.flush()
+                readable, _, _ = select.select([self.d, self.wake_read], [], [])
+                if(self.wake_read in readable):
+                    if(self.watchdog):
+                        self.watchdog.begin("fetched properties")
+                    self.handle_fetched_properties()
+                    if(self.watchdog):
+                        self.watchdog.end()
+                if(self.d not in readable):
+                    continue
             event = self.d.next_event()
-
-            if event.type == X.MapRequest:
-                self.handle_map_request(event)
-                self.taskbar.clear_area()
-            if event.type == X.ConfigureRequest:
-                self.handle_configure_request(event)
-            if event.type == X.DestroyNotify:
-                self.handle_destroy_notify(event)
-                self.taskbar.clear_area()
-            if event.type == X.UnmapNotify:
-                self.handle_unmap_notify(event)
-                self.taskbar.clear_area()
-            if event.type == X.KeyPress:
-                self.handle_key_press(event)
-            if event.type == X.ButtonPress:
-                self.handle_button_press(event)
-            if event.type == X.MotionNotify:
-                self.handle_motion_notify(event)
-            if event.type == X.ButtonRelease:
-                self.handle_button_release(event)
-            if event.type == X.ClientMessage:
-                self.handle_client_message(event)
-            self.draw_taskbar()
+            if(self.watchdog):
+                self.watchdog.begin(event)
+            if(self.recorder):
+                self.recorder.record(event)
+            self.process_event(event)
+            if(self.watchdog):
+                self.watchdog.end()
+
+    def process_event(self, event):
+        if event.type == X.MapRequest:
+            self.handle_map_request(event)
+            self.clear_taskbar()
+        if event.type == X.ConfigureRequest:
+            self.handle_configure_request(event)
+        if event.type == X.DestroyNotify:
+            self.handle_destroy_notify(event)
+            self.clear_taskbar()
+        if event.type == X.UnmapNotify:
+            self.handle_unmap_notify(event)
+            self.clear_taskbar()
+        if event.type == X.KeyPress:
+            self.handle_key_press(event)
+        if event.type == X.KeyRelease:
+            self.handle_key_release(event)
+        if event.type == X.Expose and event.window == self.switcher and event.count == 0:
+            self.draw_switcher()
+        if self.compositing and event.type == self.DAMAGE_NOTIFY:
+            self.handle_damage_notify(event)
+        if event.type == X.ButtonPress:
+            self.handle_button_press(event)
+        if event.type == X.MotionNotify:
+            self.handle_motion_notify(event)
+        if event.type == X.ButtonRelease:
+            self.handle_button_release(event)
+        if event.type == X.ClientMessage:
+            self.handle_client_message(event)
+        if event.type == X.ConfigureNotify:
+            self.handle_configure_notify(event)
+        if event.type == X.MappingNotify:
+            self.handle_mapping_notify(event)
+        if event.type == X.PropertyNotify:
+            self.handle_property_notify(event)
+        if event.type == X.FocusIn:
+            self.handle_focus_in(event)
+        if event.type == X.FocusOut:
+            self.handle_focus_out(event)
+        self.update_taskbar_visibility()
+        self.draw_taskbar()
+        self.update_ewmh()
+        self.batch.flush()
 
     def handle_map_request(self, event):
         win = event.window
         win_id = win.id
 
-        if(self.get_window_title(win) == "Polybar"):
-            win.map()
+        if self.registry.get(win_id):
+            self.batch.map(win)
             return
 
-        if win_id in self.client_to_frame or win_id in self.borderless_windows:
-            win.map()
+        if win_id in self.pending_maps:
             return
+        self.pending_maps[win_id] = win
+        self.request_properties(win_id, "map")
 
-        if self.wants_no_border(win):
-            win.change_attributes(event_mask=X.ButtonPressMask | X.ButtonReleaseMask | X.SubstructureRedirectMask | X.SubstructureNotifyMask)
-            win.map()
-            self.window_stack[self.current_workspace].append(win.id)
-
-            self.workspaces[self.current_workspace][win.id] = "max"
+    def handle_property_notify(self, event):
+        if(not self.registry.get(event.window.id)):
+            return
+        if(event.atom in (Xatom.WM_CLASS, Xatom.WM_NAME, self.NET_WM_NAME)):
+            self.request_properties(event.window.id, "update")
 
-            self.borderless_windows[win.id] = win
-            self.set_active_frame(win)
-            logger.info(f"Mapped borderless window {win_id} without frame")
+    def manage_window(self, win, properties):
+        actions = self.rules.match(properties)
+        if(not actions.get("manage", True)):
+            self.batch.map(win)
             return
 
-        attrs = win.get_attributes()
+        workspace = actions.get("workspace", self.current_workspace)
+        visible = workspace == self.current_workspace
+        layer = self.window_types_layer(properties["window_types"])
+        borderless = actions.get("borderless", self.wants_no_border(properties))
+
         geom = win.get_geometry()
+        place = self.wants_placement(actions, properties, geom, layer)
+        if(borderless):
+            x, y, width, height = self.rule_geometry(actions, geom, 0, 0)
+            if(place):
+                x, y = self.free_space(workspace).place(width + 2 * geom.border_width, height + 2 * geom.border_width)
+            if((x, y, width, height) != (geom.x, geom.y, geom.width, geom.height)):
+                self.batch.configure(win, x=x, y=y, width=width, height=height)
+            win.change_attributes(event_mask=X.ButtonPressMask | X.ButtonReleaseMask | X.SubstructureRedirectMask | X.SubstructureNotifyMask | X.PropertyChangeMask | X.FocusChangeMask)
+            record = ManagedWindow(win, workspace=workspace, layer=layer)
+            logger.info(f"Mapped borderless window {win.id} without frame")
+        else:
+            x, y, width, height = self.rule_geometry(actions, geom, 2, self.frame_border_width + 1)
+            if(place):
+                x, y = self.free_space(workspace).place(width + 2, height + self.frame_border_width + 1)
+            if((width, height) != (geom.width, geom.height)):
+                self.batch.configure(win, width=width, height=height)
+            frame, buttons = self.create_frame(win, x, y, width, height)
+            record = ManagedWindow(win, frame, buttons, workspace, layer)
+        if(borderless):
+            record.geometry = (x, y, width + 2 * geom.border_width, height + 2 * geom.border_width)
+        else:
+            record.geometry = (x, y, width + 2, height + self.frame_border_width + 1)
+        record.properties.update(properties)
+        self.registry.add(record)
+        self.occupy(record)
+        self.track_damage(record)
+        self.ewmh_add_client(win.id)
+        self.set_root_property(self.NET_NUMBER_OF_DESKTOPS, Xatom.CARDINAL, max(self.registry.stacks))
+
+        if(actions.get("floating", True) is False):
+            self.maximize_window(win)
+        if(self.NET_WM_STATE_FULLSCREEN in properties["wm_state"]):
+            self.set_fullscreen(record, True)
+
+        if(not visible):
+            # New windows start on top of the server stack, bring the model in line
+            self.raise_window(record.toplevel().id)
+            if(not self.active_frame.get(workspace)):
+                self.active_frame[workspace] = win
+            return
 
+        if(not borderless):
+            self.batch.map(record.frame)
+        self.batch.map(win)
+        active = self.active_frame.get(workspace)
+        if(actions.get("focus", True) or not active):
+            self.set_active_frame(win)
+        else:
+            # Stay behind the focused window instead of stealing focus
+            self.raise_window(record.toplevel().id)
+            self.raise_window(self.registry.get(active.id).toplevel().id)
+
+    def wants_placement(self, actions, properties, geom, layer):
+        if("geometry" in actions or actions.get("center") or layer != "normal"):
+            return False
+        flags = properties["normal_hints_flags"]
+        if(flags & Xutil.USPosition):
+            return False
+        # Clients tend to set PPosition to wherever they were created, usually 0,0
+        return not flags & Xutil.PPosition or (geom.x, geom.y) == (0, 0)
+
+    def free_space(self, workspace):
+        space = self.free_spaces.get(workspace)
+        if(space is None):
+            space = FreeSpace((0, 0, self.screen.width_in_pixels, self.screen.height_in_pixels - self.taskbar_height))
+            self.free_spaces[workspace] = space
+        return space
+
+    def occupy(self, record):
+        x, y, width, height = record.geometry
+        self.free_space(record.workspace).update(record.client.id, (x, y, x + width, y + height))
+
+    def vacate(self, record):
+        self.free_space(record.workspace).remove(record.client.id)
+
+    def handle_configure_notify(self, event):
+        self.batch.changed(event.window.id, x=event.x, y=event.y, width=event.width, height=event.height, border_width=event.border_width)
+        record = self.registry.get(event.window.id)
+        if(not record or record.toplevel().id != event.window.id):
+            return
+        border = 2 * event.border_width
+        record.geometry = (event.x, event.y, event.width + border, event.height + border)
+        if(record.client.id in self.free_space(record.workspace).windows):
+            self.occupy(record)
+
+    def handle_focus_in(self, event):
+        # Clients may take focus themselves, keep the cache honest so set_active_frame does not skip a refocus
+        if(event.mode not in (X.NotifyNormal, X.NotifyWhileGrabbed) or event.detail in (X.NotifyPointer, X.NotifyVirtual, X.NotifyNonlinearVirtual)):
+            return
+        record = self.registry.get(event.window.id)
+        if(record and record.client.id == event.window.id):
+            self.focused_window = event.window.id
+
+    def handle_focus_out(self, event):
+        if(event.mode != X.NotifyNormal or event.detail in (X.NotifyInferior, X.NotifyPointer)):
+            return
+        if(self.focused_window == event.window.id):
+            self.focused_window = None
+
+    def rule_geometry(self, actions, geom, extra_width, extra_height):
+        x, y, width, height = geom.x, geom.y, geom.width, geom.height
+        if("geometry" in actions):
+            x, y, width, height = actions["geometry"]
+        if(actions.get("center")):
+            x = (self.screen.width_in_pixels - width - extra_width) // 2
+            y = (self.screen.height_in_pixels - self.taskbar_height - height - extra_height) // 2
+        return x, y, width, height
+
+    def create_frame(self, win, x, y, width, height):
         border_width = self.frame_border_width
         frame = self.root.create_window(
-            geom.x, geom.y,
-            geom.width + 2,
-            geom.height + border_width + 1,
+            x, y,
+            width + 2,
+            height + border_width + 1,
             # border_width,
             0,
             self.screen.root_depth,
             X.InputOutput,
             X.CopyFromParent,
-            background_pixel=self.screen.black_pixel,
+            background_pixel=self.passive_background_color,
             border_pixel=self.screen.white_pixel,
             event_mask=X.SubstructureRedirectMask | X.SubstructureNotifyMask
         )
-        frame.change_attributes(event_mask=X.ButtonPressMask | X.ButtonReleaseMask | X.PointerMotionMask | X.SubstructureRedirectMask | X.SubstructureNotifyMask)
+        frame.change_attributes(event_mask=FRAME_EVENT_MASK)
 
 
         btn_size = border_width
         padding = 0
 
-        frame_width = geom.width - 1
+        frame_width = width - 1
 
         btn_close = frame.create_window(
             x=frame_width - (btn_size + padding),
@@ -835,7 +2429,7 @@ class SimplePyWM:
             depth=self.screen.root_depth,
             class_=X.InputOutput,
             visual=X.CopyFromParent,
-            background_pixel=self.colormap.alloc_named_color(config["display"]["window"]["close"]["color"]).pixel,
+            background_pixel=self.close_color,
             event_mask=X.ExposureMask | X.ButtonPressMask
         )
         btn_max = frame.create_window(
@@ -847,7 +2441,7 @@ class SimplePyWM:
             depth=self.screen.root_depth,
             class_=X.InputOutput,
             visual=X.CopyFromParent,
-            background_pixel=self.colormap.alloc_named_color(config["display"]["window"]["maximize"]["color"]).pixel,
+            background_pixel=self.maximize_color,
             event_mask=X.ExposureMask | X.ButtonPressMask
         )
         btn_min = frame.create_window(
@@ -859,7 +2453,7 @@ class SimplePyWM:
             depth=self.screen.root_depth,
             class_=X.InputOutput,
             visual=X.CopyFromParent,
-            background_pixel=self.colormap.alloc_named_color(config["display"]["window"]["minimize"]["color"]).pixel,
+            background_pixel=self.minimize_color,
             event_mask=X.ExposureMask | X.ButtonPressMask
         )
 
@@ -867,25 +2461,12 @@ class SimplePyWM:
         btn_max.map()
         btn_min.map()
 
+        win.change_attributes(event_mask=X.PropertyChangeMask | X.FocusChangeMask)
+        # Clients get reparented back to the root instead of destroyed when the window manager exits
+        win.change_save_set(X.SetModeInsert)
         win.reparent(frame, 1, border_width)
-        
-        frame.map()
-        win.map()
-
-
-        self.client_to_frame[win_id] = frame
-        self.frame_to_client[frame.id] = win
-
-        self.window_stack[self.current_workspace].append(win.id)
-        self.frame_to_button_mapping[frame.id] = (btn_close, btn_max, btn_min)
-        
-        self.workspaces[self.current_workspace][win.id] = "max"
-
-        self.frame_window_buttons[btn_close.id] = ("close", frame)
-        self.frame_window_buttons[btn_max.id] = ("maximize", frame)
-        self.frame_window_buttons[btn_min.id] = ("minimize", frame)
-
-        self.set_active_frame(win)
+        self.batch.changed(win.id, x=1, y=border_width)
+        return frame, (btn_close, btn_max, btn_min)
 
     def handle_configure_request(self, event):
         values = {}
@@ -899,79 +2480,129 @@ class SimplePyWM:
             values["height"] = event.height
         if event.value_mask & X.CWBorderWidth:
             values["border_width"] = event.border_width
-        if event.value_mask & X.CWSibling:
-            values["sibling"] = event.above
-        if event.value_mask & X.CWStackMode:
-            values["stack_mode"] = event.stack_mode
-        event.window.configure(**values)
+        record = self.registry.get(event.window.id)
+        if(record and record.fullscreen is not None):
+            # A fullscreen window keeps covering the monitor, only its stacking request is honoured
+            if(event.value_mask & X.CWStackMode):
+                self.restack_request(record, event)
+            self.send_configure_notify(record)
+            return
+        if(record and event.value_mask & X.CWStackMode):
+            # Stack requests of managed windows go through the model so layers keep holding
+            self.restack_request(record, event)
+            if(not values):
+                self.send_configure_notify(record)
+                return
+        else:
+            if event.value_mask & X.CWSibling:
+                values["sibling"] = event.sibling
+            if event.value_mask & X.CWStackMode:
+                values["stack_mode"] = event.stack_mode
+                # The client restacked itself, its place in the model is no longer known
+                self.forget_stacking(event.window.id)
+        # Clients wait for the ConfigureNotify of every request, even one that changes nothing
+        self.batch.configure(event.window, force=True, **values)
+
+    def restack_request(self, record, event):
+        win_id = record.toplevel().id
+        order = [stacked_id for stacked_id in self.stacking if stacked_id != win_id]
+        sibling = None
+        if(event.value_mask & X.CWSibling):
+            sibling_record = self.registry.get(getattr(event.sibling, "id", event.sibling))
+            if(sibling_record and sibling_record.toplevel().id in order):
+                sibling = sibling_record.toplevel().id
+        if(sibling is not None):
+            index = order.index(sibling)
+            order.insert(index if event.stack_mode in (X.Below, X.BottomIf) else index + 1, win_id)
+        elif(event.stack_mode in (X.Below, X.BottomIf)):
+            order.insert(0, win_id)
+        else:
+            order.append(win_id)
+        order.sort(key=self.window_layer)
+        self.restack_windows(order)
+
+    def send_configure_notify(self, record):
+        # ICCCM 4.1.5: a request the window manager did not act on still gets a synthetic
+        # ConfigureNotify in root coordinates
+        x, y, width, height = record.geometry
+        if(record.fullscreen is not None):
+            x, y, width, height = 0, 0, self.screen.width_in_pixels, self.screen.height_in_pixels
+        elif(not record.borderless):
+            x, y = x + 1, y + self.frame_border_width
+            width, height = width - 2, height - self.frame_border_width - 1
+        notify = xevent.ConfigureNotify(
+            sequence_number=0,
+            window=record.client,
+            event=record.client,
+            above_sibling=X.NONE,
+            x=x, y=y,
+            width=width, height=height,
+            border_width=0,
+            override=False
+        )
+        record.client.send_event(notify, event_mask=X.StructureNotifyMask)
 
     def handle_destroy_notify(self, event):
         win_id = event.window.id
 
-        borderless = 0
-        not_tracked = 0
-        if(win_id in self.borderless_windows):
-            win = self.borderless_windows[win_id]
-            borderless = 1
-        else:
-            if(win_id in self.frame_to_client):
-                win = self.frame_to_client[win_id]
-                frame = self.client_to_frame[win.id]
-            elif(win_id in self.client_to_frame):
-                frame = self.client_to_frame[win_id]
-                win = self.frame_to_client[frame.id]
-            else:
-                not_tracked = 1
-        
-        if(not_tracked):
+        record = self.registry.get(win_id)
+        if(not record):
+            self.pending_maps.pop(win_id, None)
+            self.batch.forget([win_id])
             event.window.destroy()
             return
-        if(win.id in self.window_stack[self.current_workspace]):
-            if(self.active_frame[self.current_workspace].id == win.id):
-                idx = self.window_stack[self.current_workspace].index(win.id)
-                next_frame = self.window_stack[self.current_workspace][(idx - 1) % len(self.window_stack[self.current_workspace])]
+        win = record.client
+        workspace = record.workspace
+        stack = self.registry.stack(workspace)
+
+        active = self.active_frame.get(workspace)
+        if(active and active.id == win.id and win.id in stack):
+            idx = stack.index(win.id)
+            next_frame = stack[(idx - 1) % len(stack)]
+            if(workspace == self.current_workspace):
                 self.set_active_frame(self.fetch_win_using_id(next_frame))
-            self.window_stack[self.current_workspace].remove(win.id)
-        
-        if(not borderless):
-            del self.frame_to_client[frame.id]
-            del self.client_to_frame[win.id]
-            frame.destroy()
-        else:
-            del self.borderless_windows[win.id]
+            else:
+                self.active_frame[workspace] = self.fetch_win_using_id(next_frame)
+
+        self.ewmh_remove_client(win.id)
+        self.vacate(record)
+        self.registry.remove(record)
+        self.thumbnails.remove(win.id)
+        self.forget_stacking(record.toplevel().id)
+        if(self.focused_window == win.id):
+            self.focused_window = None
+        self.batch.forget(record.ids())
+        if(not record.borderless):
+            record.frame.destroy()
         win.destroy()
-        del self.workspaces[self.current_workspace][win.id]
+        logger.debug(f"Window registry after removing {win.id}: {self.registry.report()}")
 
-        if(not len(self.window_stack[self.current_workspace])):
-            self.active_frame[self.current_workspace] = None
-            self.root.set_input_focus(X.RevertToPointerRoot, X.CurrentTime)
-            self.d.flush()
+        if(not len(stack)):
+            self.active_frame[workspace] = None
+            if(workspace == self.current_workspace):
+                self.set_root_property(self.NET_ACTIVE_WINDOW, Xatom.WINDOW, X.NONE)
+                self.batch.set_input_focus(self.root, X.RevertToPointerRoot)
+                self.focused_window = None
 
     def handle_unmap_notify(self, event):
-        win_id = event.window.id
-
-        borderless = 0
-        not_tracked = 0
-        if(win_id in self.borderless_windows):
-            win = self.borderless_windows[win_id]
-            borderless = 1
-        else:
-            if(win_id in self.frame_to_client):
-                win = self.frame_to_client[win_id]
-                frame = self.client_to_frame[win.id]
-            elif(win_id in self.client_to_frame):
-                frame = self.client_to_frame[win_id]
-                win = self.frame_to_client[frame.id]
-            else:
-                not_tracked = 1
-        if(not_tracked):
+        record = self.registry.get(event.window.id)
+        if(not record):
+            self.batch.unmapped(event.window.id)
             return
-
-        if(win.id in self.workspaces[self.current_workspace]):
-            self.workspaces[self.current_workspace][win.id] = "min"
-        if(not borderless):
-            frame.unmap()
-        win.unmap()
+        if(record.ignore_unmaps and event.window.id == record.client.id):
+            record.ignore_unmaps -= 1
+            return
+        self.batch.unmapped(event.window.id)
+
+        if(record.workspace == self.current_workspace):
+            record.state = "min"
+            self.vacate(record)
+        if(self.focused_window == record.client.id):
+            # The server reverts focus on its own once the window is gone
+            self.focused_window = None
+        if(not record.borderless):
+            self.batch.unmap(record.frame)
+        self.batch.unmap(record.client)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,474 @@
+import argparse
+import base64
+import json
+import time
+from types import SimpleNamespace
+
+from Xlib import X, Xatom
+from Xlib.ext import damage
+from Xlib.protocol import event as xevent, request
+
+import main
+
+# Replays a trace written by EventRecorder through SimplePyWM against a stub
+# display, timing every handler. No X server is needed.
+
+TIMED_METHODS = [
+    "process_event",
+    "draw_taskbar",
+    "update_ewmh",
+    "set_active_frame",
+    "set_frame_window_buttons",
+    "switch_workspace",
+    "maximize_window",
+    "cycle_windows",
+    "draw_switcher",
+    "get_window_title",
+    "wants_no_border",
+    "manage_window"
+]
+
+class StubResource:
+    def __init__(self, display, resource_id):
+        self.display = display
+        self.id = resource_id
+
+    def __eq__(self, other):
+        return isinstance(other, StubResource) and self.id == other.id
+
+    def __hash__(self):
+        return self.id
+
+    def __resource__(self):
+        return self.id
+
+    def __getattr__(self, name):
+        # Requests the replay does not care about (fill_rectangle, grab_key, ...)
+        def request(*args, **keys):
+            self.display.requests += 1
+            return None
+        return request
+
+    # Freed ids go back to the allocator like in Xlib, the next id handed out depends on it
+    def free(self, **keys):
+        self.display.requests += 1
+        self.display.free_resource_id(self.id)
+
+    def destroy(self, **keys):
+        self.display.requests += 1
+        self.display.free_resource_id(self.id)
+
+class StubFont(StubResource):
+    def query(self):
+        self.display.round_trips += 1
+        return SimpleNamespace(
+            min_char_or_byte2=0,
+            default_char=0,
+            char_infos=[],
+            max_bounds=SimpleNamespace(character_width=6)
+        )
+
+    def create_glyph_cursor(self, *args, **keys):
+        self.display.requests += 1
+        return StubResource(self.display, self.display.allocate_resource_id())
+
+class StubPixmap(StubResource):
+    def get_image(self, x, y, width, height, format, plane_mask):
+        # 32 bits per pixel like a depth 24 server
+        self.display.round_trips += 1
+        return SimpleNamespace(data=bytes(width * height * 4))
+
+class StubWindow(StubResource):
+    __window__ = StubResource.__resource__
+    __drawable__ = StubResource.__resource__
+
+    def __init__(self, display, resource_id, x=0, y=0, width=640, height=480):
+        super().__init__(display, resource_id)
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.border_width = 0
+        self.mapped = False
+        self.override_redirect = False
+        self.input_only = False
+        self.wm_class = None
+        self.wm_name = None
+        self.normal_hints = None
+        self.properties = {}
+        self.children = []
+
+    def create_window(self, x, y, width, height, border_width, depth, *args, **keys):
+        self.display.requests += 1
+        return self.display.add_window(self.display.allocate_resource_id(), x, y, width, height)
+
+    def create_gc(self, **keys):
+        self.display.requests += 1
+        return StubResource(self.display, self.display.allocate_resource_id())
+
+    def create_pixmap(self, width, height, depth):
+        self.display.requests += 1
+        return StubPixmap(self.display, self.display.allocate_resource_id())
+
+    def composite_name_window_pixmap(self, **keys):
+        self.display.requests += 1
+        return StubPixmap(self.display, self.display.allocate_resource_id())
+
+    def damage_create(self, level):
+        self.display.requests += 1
+        return self.display.allocate_resource_id()
+
+    def configure(self, **keys):
+        self.display.requests += 1
+        for name in ("x", "y", "width", "height"):
+            if(name in keys):
+                setattr(self, name, keys[name])
+
+    def map(self, **keys):
+        self.display.requests += 1
+        self.mapped = True
+
+    def unmap(self, **keys):
+        self.display.requests += 1
+        self.mapped = False
+
+    def get_geometry(self):
+        self.display.round_trips += 1
+        return SimpleNamespace(**self.geometry_reply())
+
+    def get_attributes(self):
+        self.display.round_trips += 1
+        return SimpleNamespace(**self.attributes_reply())
+
+    def geometry_reply(self):
+        return dict(x=self.x, y=self.y, width=self.width, height=self.height, border_width=self.border_width, depth=self.display.depth, root=self.display.root)
+
+    def attributes_reply(self):
+        map_state = X.IsViewable if self.mapped else X.IsUnmapped
+        win_class = X.InputOnly if self.input_only else X.InputOutput
+        return dict(map_state=map_state, override_redirect=int(self.override_redirect), win_class=win_class, your_event_mask=0, all_event_masks=0)
+
+    def property_reply(self, atom):
+        # GetProperty as the server answers it, including the properties kept in their own fields
+        if(atom == Xatom.WM_CLASS and self.wm_class):
+            return dict(property_type=Xatom.STRING, value=(8, ("\0".join(self.wm_class) + "\0").encode("latin-1")))
+        if(atom == Xatom.WM_NAME and self.wm_name is not None):
+            return dict(property_type=Xatom.STRING, value=(8, self.wm_name.encode("latin-1", errors="replace")))
+        if(atom == Xatom.WM_NORMAL_HINTS and self.normal_hints):
+            return dict(property_type=Xatom.WM_SIZE_HINTS, value=(32, [self.normal_hints.flags]))
+        prop = self.properties.get(atom)
+        if(not prop):
+            return dict(property_type=X.NONE, value=(0, []))
+        return dict(property_type=prop.property_type, value=(prop.format, prop.value))
+
+    def get_wm_class(self):
+        self.display.round_trips += 1
+        return self.wm_class
+
+    def query_tree(self):
+        # Only the root has children: the windows open when the trace started
+        self.display.round_trips += 1
+        return SimpleNamespace(root=self.display.root, parent=None, children=list(self.children))
+
+    def get_wm_normal_hints(self):
+        self.display.round_trips += 1
+        return self.normal_hints
+
+    def get_wm_name(self):
+        self.display.round_trips += 1
+        return self.wm_name
+
+    def get_full_property(self, atom, property_type, sizehint=10):
+        self.display.round_trips += 1
+        return self.properties.get(atom)
+
+    def change_property(self, atom, property_type, format, data, mode=X.PropModeReplace, onerror=None):
+        self.display.requests += 1
+        if(mode == X.PropModeAppend and atom in self.properties):
+            data = list(self.properties[atom].value) + list(data)
+        self.properties[atom] = SimpleNamespace(property_type=property_type, format=format, value=data)
+
+class StubColormap:
+    def __init__(self, display):
+        self.display = display
+
+    def alloc_named_color(self, name):
+        self.display.round_trips += 1
+        return SimpleNamespace(pixel=0)
+
+class StubConnection:
+    # The protocol connection behind StubDisplay.display, for requests main.py sends itself
+    # (defer=True batches). Replies are filled in right away, reply() then never waits.
+    def __init__(self, display):
+        self.stub = display
+
+    def send_request(self, req, wait_for_response):
+        self.stub.requests += 1
+        if(not isinstance(req, (request.GetWindowAttributes, request.GetGeometry, request.GetProperty))):
+            return
+        fields, _ = req._request.parse_binary(req._binary, self, rawdict=True)
+        if(isinstance(req, request.GetWindowAttributes)):
+            req._data = self.stub.window(self.stub, fields["window"]).attributes_reply()
+        elif(isinstance(req, request.GetGeometry)):
+            req._data = self.stub.window(self.stub, fields["drawable"]).geometry_reply()
+        else:
+            req._data = self.stub.window(self.stub, fields["window"]).property_reply(fields["property"])
+
+    def get_resource_class(self, class_name, default=None):
+        # Request fields are parsed as plain ids
+        return None
+
+class StubDisplay:
+    def __init__(self, header):
+        self.resource_id_base = header["resource_id_base"]
+        self.resource_id_mask = header["resource_id_mask"]
+        self.resource_ids = set()
+        self.last_resource_id = 0
+        # Composite and Damage allocate ids too, so they are only offered when the recording had them
+        self.extensions = header.get("extensions", [])
+        self.extension_event = SimpleNamespace(DamageNotify=header.get("damage_notify"))
+        self.depth = header["depth"]
+        self.windows = {}
+        self.atoms = {}
+        self.requests = 0
+        self.round_trips = 0
+        # Whether Alt was down at the last key event, answered by query_keymap
+        self.alt_down = False
+
+        self.min_keycode = header["min_keycode"]
+        self.keyboard_mapping = header["keyboard_mapping"]
+        self.modifier_mapping = header["modifier_mapping"]
+
+        self.display = StubConnection(self)
+
+        self.root = self.add_window(header["root"], 0, 0, header["width"], header["height"])
+        self.root.mapped = True
+        for snapshot in header.get("windows", []):
+            win = self.add_window(snapshot["id"])
+            load_window(self, win, snapshot)
+            win.mapped = snapshot["mapped"]
+            win.override_redirect = snapshot["override_redirect"]
+            win.input_only = snapshot["input_only"]
+            self.root.children.append(win)
+        self.screen_info = SimpleNamespace(
+            root=self.root,
+            width_in_pixels=header["width"],
+            height_in_pixels=header["height"],
+            root_depth=header["depth"],
+            default_colormap=StubColormap(self),
+            black_pixel=0,
+            white_pixel=1
+        )
+
+    # Mirrors Xlib's allocator so ids match the ones seen in the recorded events
+    def allocate_resource_id(self):
+        resource_id = self.last_resource_id
+        while resource_id in self.resource_ids:
+            resource_id += 1
+        self.resource_ids.add(resource_id)
+        self.last_resource_id = resource_id
+        return self.resource_id_base | resource_id
+
+    def free_resource_id(self, resource_id):
+        if(resource_id & ~self.resource_id_mask == self.resource_id_base):
+            self.resource_ids.discard(resource_id & self.resource_id_mask)
+
+    def add_window(self, win_id, x=0, y=0, width=640, height=480):
+        win = StubWindow(self, win_id, x, y, width, height)
+        self.windows[win_id] = win
+        return win
+
+    def window(self, display, win_id):
+        if(win_id in self.windows):
+            return self.windows[win_id]
+        return self.add_window(win_id)
+
+    def get_resource_class(self, class_name, default=None):
+        if(class_name == "window"):
+            return self.window
+        return lambda display, resource_id: StubResource(self, resource_id)
+
+    def create_resource_object(self, type, resource_id):
+        if(isinstance(resource_id, StubResource)):
+            resource_id = resource_id.id
+        if(type == "window"):
+            return self.window(self, resource_id)
+        return StubResource(self, resource_id)
+
+    def screen(self):
+        return self.screen_info
+
+    def open_font(self, name):
+        self.requests += 1
+        return StubFont(self, self.allocate_resource_id())
+
+    def intern_atom(self, name, only_if_exists=False):
+        # Uncached in python-xlib, every call waits for the server
+        self.round_trips += 1
+        return self.atom(name)
+
+    def atom(self, name):
+        # For the replay itself, not counted
+        if(hasattr(Xatom, name)):
+            return getattr(Xatom, name)
+        if(name not in self.atoms):
+            self.atoms[name] = Xatom.LAST_PREDEFINED + 1 + len(self.atoms)
+        return self.atoms[name]
+
+    def keycode_to_keysym(self, keycode, index):
+        try:
+            return self.keyboard_mapping[keycode - self.min_keycode][index]
+        except IndexError:
+            return X.NoSymbol
+
+    def keysym_to_keycode(self, keysym):
+        for index in range(len(self.keyboard_mapping[0]) if self.keyboard_mapping else 0):
+            for offset, syms in enumerate(self.keyboard_mapping):
+                if(index < len(syms) and syms[index] == keysym):
+                    return offset + self.min_keycode
+        return 0
+
+    def get_modifier_mapping(self):
+        return self.modifier_mapping
+
+    def query_keymap(self):
+        self.round_trips += 1
+        keymap = [0] * 32
+        if(self.alt_down):
+            for keycode in self.modifier_mapping[X.Mod1MapIndex]:
+                keymap[keycode // 8] |= 1 << (keycode % 8)
+        return keymap
+
+    def refresh_keyboard_mapping(self, event):
+        pass
+
+    def ungrab_keyboard(self, time):
+        self.requests += 1
+
+    def has_extension(self, name):
+        return name in self.extensions
+
+    def composite_query_version(self):
+        self.round_trips += 1
+
+    def damage_query_version(self):
+        self.round_trips += 1
+
+    def damage_destroy(self, damage):
+        self.requests += 1
+        self.free_resource_id(damage)
+
+    def damage_subtract(self, damage, repair=X.NONE, parts=X.NONE):
+        self.requests += 1
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        self.round_trips += 1
+
+    def ungrab_pointer(self, time):
+        self.requests += 1
+
+def load_trace(file_name):
+    with open(file_name) as file:
+        header = json.loads(file.readline())["header"]
+        entries = [json.loads(line) for line in file if line.strip()]
+    return header, entries
+
+def set_property(d, win, name, property_type, value):
+    if(value is None):
+        return
+    if(property_type == Xatom.ATOM):
+        value = [d.atom(atom) for atom in value]
+    win.properties[d.atom(name)] = SimpleNamespace(property_type=property_type, format=32, value=value)
+
+def load_window(d, win, snapshot):
+    # Restores what EventRecorder.snapshot kept of a window
+    win.x, win.y, win.width, win.height = snapshot["geometry"]
+    win.border_width = snapshot.get("border_width", 0)
+    win.wm_class = tuple(snapshot["wm_class"]) if snapshot["wm_class"] else None
+    set_property(d, win, "_NET_WM_WINDOW_TYPE", Xatom.ATOM, snapshot.get("window_types"))
+    set_property(d, win, "_MOTIF_WM_HINTS", d.atom("_MOTIF_WM_HINTS"), snapshot.get("motif_hints"))
+    set_property(d, win, "_NET_WM_STATE", Xatom.ATOM, snapshot.get("wm_state"))
+    net_wm_name = snapshot.get("net_wm_name")
+    if(net_wm_name is not None):
+        win.properties[d.atom("_NET_WM_NAME")] = SimpleNamespace(property_type=d.atom("UTF8_STRING"), format=8, value=net_wm_name.encode())
+    win.wm_name = snapshot.get("wm_name")
+    win.normal_hints = SimpleNamespace(flags=snapshot.get("normal_hints_flags", 0))
+
+def parse_event(d, entry):
+    data = base64.b64decode(entry["event"])
+    event_class = xevent.event_class.get(data[0] & 0x7f)
+    if(d.extension_event.DamageNotify is not None and data[0] & 0x7f == d.extension_event.DamageNotify):
+        event_class = damage.DamageNotify
+    if(not event_class):
+        return None
+    event = event_class(display=d, binarydata=data)
+    if(event.type == X.KeyPress):
+        d.alt_down = bool(event.state & X.Mod1Mask)
+    elif(event.type == X.KeyRelease and event.detail in d.modifier_mapping[X.Mod1MapIndex]):
+        d.alt_down = False
+    if("window" in entry):
+        load_window(d, event.window, entry["window"])
+    return event
+
+def timed(name, method, stats):
+    def wrapper(*args, **keys):
+        start = time.perf_counter()
+        try:
+            return method(*args, **keys)
+        finally:
+            stats.setdefault(name, []).append(time.perf_counter() - start)
+    return wrapper
+
+def replay(file_name):
+    header, entries = load_trace(file_name)
+    d = StubDisplay(header)
+    main.config["debug"]["trace_file"] = ""
+    main.config["debug"]["stall_threshold_ms"] = 0
+    wm = main.SimplePyWM(d, background_fetch=False)
+
+    stats = {}
+    names = TIMED_METHODS + [name for name in dir(wm) if name.startswith("handle_")]
+    for name in names:
+        setattr(wm, name, timed(name, getattr(wm, name), stats))
+
+    skipped = 0
+    start = time.perf_counter()
+    for entry in entries:
+        event = parse_event(d, entry)
+        if(event is None):
+            skipped += 1
+            continue
+        wm.process_event(event)
+    total = time.perf_counter() - start
+
+    return {
+        "events": len(entries) - skipped,
+        "skipped": skipped,
+        "seconds": total,
+        "requests": d.requests,
+        "round_trips": d.round_trips,
+        "batched": wm.batch.queued,
+        "batch_saved": wm.batch.saved,
+        "stats": stats
+    }
+
+def print_report(result):
+    print(f"{result['events']} events replayed in {result['seconds'] * 1000:.1f} ms "
+          f"({result['skipped']} skipped, {result['requests']} requests, {result['round_trips']} round trips)")
+    print(f"{result['batched']} window changes batched, {result['batch_saved']} requests saved by merging")
+    print(f"{'handler':32} {'calls':>8} {'total ms':>10} {'mean us':>10} {'p95 us':>10} {'max us':>10}")
+    rows = sorted(result["stats"].items(), key=lambda item: sum(item[1]), reverse=True)
+    for name, samples in rows:
+        samples = sorted(samples)
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        print(f"{name:32} {len(samples):>8} {sum(samples) * 1000:>10.2f} "
+              f"{sum(samples) / len(samples) * 1e6:>10.1f} {p95 * 1e6:>10.1f} {samples[-1] * 1e6:>10.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a SimplePyWM event trace without an X server")
+    parser.add_argument("trace", help="trace file written with debug.trace_file")
+    args = parser.parse_args()
+    print_report(replay(args.trace))